@@ -1,26 +1,40 @@
 import argparse
+import atexit
 import os
+import queue
 import sys
-import time
+import threading
 import logging
+import logging.handlers
 
-# Adiciona o diretório raiz ao path para que possamos importar 'minibit'
-sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+def _setup_logging():
+    """Configura logging assíncrono: as threads quentes só enfileiram.
 
-from minibit.tracker import Tracker
-from minibit.peer import Peer
+    O handler de console fica atrás de um QueueListener em uma thread
+    dedicada; emitir um log no reator ou nos loops de rede custa um
+    put na fila, sem write bloqueante segurando o lock de logging.
+    """
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        datefmt='%H:%M:%S'
+    ))
+    log_queue: 'queue.Queue' = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, console,
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
 
 def main():
     """
     Ponto de entrada principal para iniciar o Tracker ou os Peers do MiniBit.
     Utiliza argparse para interpretar os comandos da linha de comando.
     """
-    # Configuração básica de logging
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        datefmt='%H:%M:%S'
-    )
+    _setup_logging()
 
     # Parser principal
     parser = argparse.ArgumentParser(description="MiniBit: Um cliente P2P para compartilhamento de arquivos.")
@@ -40,6 +54,10 @@ def main():
     args = parser.parse_args()
 
     if args.command == "tracker":
+        # Import tardio: o modo tracker não paga o custo de importar o Peer
+        # (e suas dependências opcionais), e vice-versa
+        from minibit.tracker import Tracker
+
         # Inicia o Tracker
         tracker = Tracker(host=args.host, port=args.port)
         try:
@@ -49,6 +67,8 @@ def main():
             tracker.stop()
 
     elif args.command == "peer":
+        from minibit.peer import Peer
+
         # Validação dos argumentos do Peer
         if not args.file_path and not args.file_name:
             print("Erro: Você precisa especificar --file-path (para ser seeder) ou --file-name (para ser leecher).")
@@ -79,19 +99,22 @@ def main():
 
         # Mantém o peer rodando
         try:
-            while not peer.is_download_complete():
-                time.sleep(2)
+            # Bloqueia até o último bloco chegar, sem polling
+            peer.wait_download_complete()
             
             # Se o download estiver completo, o peer agora é um seeder.
             # Ele continuará rodando para compartilhar com outros.
-            logging.info(f"Peer {peer.peer_id} se tornou um seeder. Pressione Ctrl+C para sair.")
-            while True:
-                time.sleep(1)
+            logging.info("Peer %s se tornou um seeder. Pressione Ctrl+C para sair.", peer.peer_id)
+            # Estaciona sem acordar a cada segundo: o wait só termina
+            # com o KeyboardInterrupt
+            threading.Event().wait()
 
         except KeyboardInterrupt:
-            logging.info(f"Peer {peer.peer_id} encerrado pelo usuário.")
+            logging.info("Peer %s encerrado pelo usuário.", peer.peer_id)
         finally:
             peer.stop()
 
 if __name__ == "__main__":
+    # Adiciona o diretório raiz ao path para que possamos importar 'minibit'
+    sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
     main()
\ No newline at end of file
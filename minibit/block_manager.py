@@ -1,24 +1,68 @@
 import os
+import mmap
+import base64
+import hashlib
+import heapq
 import logging
-from typing import Set, Dict, List, Optional, Tuple
+import threading
+from typing import Set, Dict, FrozenSet, List, Optional, Tuple
+
+# Limite de buffers que um único os.writev aceita (IOV_MAX do kernel)
+_IOV_MAX = 1024
 
 class BlockManager:
     """
     Gerencia os blocos de um arquivo: lê, armazena, reconstrói e
     rastreia a raridade dos blocos na rede.
     """
+    # Tetos para o total de blocos anunciado por fontes remotas: um valor
+    # forjado não pode nos fazer alocar tabelas de ids gigantes nem um
+    # slab de download de dezenas de GiB (mesmo espírito do
+    # MAX_MESSAGE_SIZE no protocolo). O limite efetivo considera o
+    # block_size, para que total * block_size caiba no orçamento
+    MAX_TOTAL_BLOCKS = 1_000_000
+    MAX_FILE_BYTES = 1 << 30  # 1 GiB
+
     def __init__(self, file_name: str, block_size: int, logger: logging.Logger):
         self.file_name = file_name
         self.block_size = block_size
         self.logger = logger
-        
-        self.my_blocks: Dict[str, bytes] = {}
+
+        # No seeder os valores são memoryviews sobre o mmap do arquivo
+        # (zero-copy); no leecher, fatias de um buffer contíguo único
+        self.my_blocks: Dict[str, 'bytes | memoryview'] = {}
+        self._mmap: Optional[mmap.mmap] = None
+        # Slab do leecher: um bytearray com um slot de block_size por
+        # bloco, preenchido conforme os blocos chegam — a reconstrução
+        # vira uma única escrita sequencial em vez de N buffers esparsos
+        self._slab: Optional[bytearray] = None
         self.total_block_count = 0
         self.all_block_ids: List[str] = []
+        # Cache de block_id -> índice numérico (e o inverso), para não
+        # re-parsear o sufixo da string a cada comparação de ordenação
+        self._block_index: Dict[str, int] = {}
+        self._id_by_index: Dict[int, str] = {}
+
+        # Posse de blocos como bitmask (bit i ligado = possui o bloco de
+        # índice i). Diferença de conjuntos e raridade viram operações de
+        # inteiros em vez de sets de strings com hashing por elemento.
+        self._have_mask = 0
+        # Cache do frozenset de posse, invalidado quando um bloco chega
+        self._my_blocks_frozen: Optional[FrozenSet[str]] = None
+        # Cache da codificação base64 da posse (get_have_bitmap), com a
+        # mesma política de invalidação
+        self._have_bitmap_cache: Optional[Tuple[str, int]] = None
+        # Digests SHA-256 já calculados, por bloco: um seeder não paga o
+        # hash de novo a cada peer que pede o mesmo bloco
+        self._digest_cache: Dict[str, str] = {}
+        self._peer_masks: Dict[str, int] = {}
+        # Contadores de raridade mantidos incrementalmente a cada mudança
+        # de máscara: {índice do bloco: nº de peers que o têm}
+        self._rarity_counts: Dict[int, int] = {}
+        # Sinalizado pelo add_block que completa o arquivo; quem espera o
+        # fim do download bloqueia nele em vez de fazer polling
+        self._complete_event = threading.Event()
 
-        # Estrutura: {block_id: {peer_id1, peer_id2, ...}}
-        self.peer_block_map: Dict[str, Set[str]] = {}
-        
         self.download_dir = "downloads"
         os.makedirs(self.download_dir, exist_ok=True)
 
@@ -27,48 +71,223 @@ class BlockManager:
         try:
             file_size = os.path.getsize(file_path)
             self.total_block_count = (file_size + self.block_size - 1) // self.block_size
-            
+
             base_name = os.path.basename(file_path)
             self.all_block_ids = [f"{base_name}_{i}" for i in range(self.total_block_count)]
+            self._block_index = {bid: i for i, bid in enumerate(self.all_block_ids)}
+            self._id_by_index = {i: bid for i, bid in enumerate(self.all_block_ids)}
 
-            with open(file_path, 'rb') as f:
+            # mmap em vez de read(): os blocos viram fatias zero-copy do
+            # page cache, sem duplicar o arquivo inteiro em RAM
+            if self.total_block_count:
+                fd = os.open(file_path, os.O_RDONLY)
+                try:
+                    self._mmap = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+                finally:
+                    os.close(fd)
+                view = memoryview(self._mmap)
                 for i, block_id in enumerate(self.all_block_ids):
-                    data = f.read(self.block_size)
-                    self.my_blocks[block_id] = data
-            self.logger.info(f"Arquivo '{file_path}' carregado com {len(self.my_blocks)} blocos.")
+                    self.my_blocks[block_id] = view[i * self.block_size:(i + 1) * self.block_size]
+            self._have_mask = (1 << self.total_block_count) - 1
+            self._my_blocks_frozen = None
+            self._have_bitmap_cache = None
+            if self.total_block_count > 0:
+                self._complete_event.set()
+            self.logger.info("Arquivo '%s' carregado com %s blocos.", file_path, len(self.my_blocks))
         except FileNotFoundError:
-            self.logger.error(f"Arquivo não encontrado: {file_path}")
+            self.logger.error("Arquivo não encontrado: %s", file_path)
 
-    def add_block(self, block_id: str, data: bytes) -> bool:
-        """Adiciona um bloco recém-baixado."""
+    def _index_of(self, block_id: str) -> int:
+        """Retorna o índice numérico de um bloco, parseando a string uma única vez."""
+        idx = self._block_index.get(block_id)
+        if idx is None:
+            idx = int(block_id.split('_')[-1])
+            self._block_index[block_id] = idx
+            self._id_by_index[idx] = block_id
+        return idx
+
+    @staticmethod
+    def _iter_bits(mask: int):
+        """Itera os índices dos bits ligados de uma máscara."""
+        while mask:
+            lsb = mask & -mask
+            yield lsb.bit_length() - 1
+            mask ^= lsb
+
+    def add_block(self, block_id: str, data: bytes, digest: Optional[str] = None) -> bool:
+        """Adiciona um bloco recém-baixado.
+
+        Se o remetente anunciou um digest SHA-256, o bloco é verificado
+        antes de ser aceito (o hash lê o buffer direto, sem cópia);
+        um bloco corrompido é descartado e volta a ser elegível para
+        requisição.
+        """
         if block_id in self.my_blocks:
             return False
-            
+
+        if digest is not None:
+            actual = hashlib.sha256(data).hexdigest()
+            if actual != digest:
+                self.logger.warning("Bloco '%s' corrompido (digest não confere); descartado.", block_id)
+                return False
+            self._digest_cache[block_id] = digest
+
+        if self._mmap is None and self._slab is None and self.total_block_count:
+            self._slab = bytearray(self.total_block_count * self.block_size)
+        if self._slab is not None:
+            offset = self._index_of(block_id) * self.block_size
+            self._slab[offset:offset + len(data)] = data
+            data = memoryview(self._slab)[offset:offset + len(data)]
+
         self.my_blocks[block_id] = data
-        self.logger.info(f"Recebido bloco '{block_id}'")
+        self._have_mask |= 1 << self._index_of(block_id)
+        self._my_blocks_frozen = None
+        self._have_bitmap_cache = None
+        if self.total_block_count and len(self.my_blocks) == self.total_block_count:
+            self._complete_event.set()
+        self.logger.debug("Recebido bloco '%s'", block_id)
         return True
 
-    def get_block_data(self, block_id: str) -> Optional[bytes]:
+    def get_block_data(self, block_id: str) -> Optional['bytes | memoryview']:
         """Retorna os dados de um bloco que o peer possui."""
         return self.my_blocks.get(block_id)
 
-    def get_my_blocks(self) -> Set[str]:
-        """Retorna os IDs de todos os blocos que o peer possui."""
-        return set(self.my_blocks.keys())
+    def get_block_digest(self, block_id: str) -> Optional[str]:
+        """Retorna (calculando uma única vez) o SHA-256 de um bloco nosso."""
+        digest = self._digest_cache.get(block_id)
+        if digest is None:
+            data = self.my_blocks.get(block_id)
+            if data is None:
+                return None
+            # sha256 aceita memoryview: a fatia do mmap é lida sem cópia
+            digest = hashlib.sha256(data).hexdigest()
+            self._digest_cache[block_id] = digest
+        return digest
+
+    def close(self):
+        """Libera as fatias, o slab e o mmap do arquivo de origem, se houver."""
+        if self._slab is not None:
+            self.my_blocks.clear()
+            self._slab = None
+        if self._mmap is not None:
+            self.my_blocks.clear()
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Ainda existem fatias exportadas em uso; o GC libera o
+                # mmap quando a última referência sumir
+                pass
+            self._mmap = None
+
+    def get_my_blocks(self) -> FrozenSet[str]:
+        """Retorna os IDs de todos os blocos que o peer possui.
+
+        O frozenset é cacheado e invalidado em add_block: os chamadores
+        periódicos (lógica de unchoke, interesse) não pagam uma cópia do
+        conjunto inteiro a cada chamada.
+        """
+        if self._my_blocks_frozen is None:
+            self._my_blocks_frozen = frozenset(self.my_blocks)
+        return self._my_blocks_frozen
+
+    def get_have_bitmap(self) -> Tuple[str, int]:
+        """Codifica nossa posse como (bitmap base64, total de blocos).
+
+        O bitmap de M/8 bytes substitui a lista de M strings de id no
+        protocolo — ordens de grandeza menos bytes e parse. O resultado é
+        cacheado: broadcasts e syncs com o tracker entre dois blocos novos
+        reutilizam a mesma string, sem re-codificar a posse a cada envio.
+        """
+        if self._have_bitmap_cache is None:
+            nbytes = (max(self._have_mask.bit_length(), 1) + 7) // 8
+            bitmap = base64.b64encode(self._have_mask.to_bytes(nbytes, 'little'))
+            self._have_bitmap_cache = (bitmap.decode('ascii'), self.total_block_count)
+        return self._have_bitmap_cache
+
+    def update_peer_bitmap(self, peer_id: str, bitmap_b64: str, total: int):
+        """Atualiza a posse de um peer a partir de um bitmap recebido.
+
+        O total explícito permite inicializar all_block_ids corretamente
+        mesmo quando o primeiro peer visto tem só parte do arquivo.
+        Valores remotos são validados: total acima de MAX_TOTAL_BLOCKS
+        ou bitmap com mais bits do que o total são descartados.
+        """
+        max_total = min(self.MAX_TOTAL_BLOCKS, self.MAX_FILE_BYTES // self.block_size)
+        if not 0 <= total <= max_total:
+            self.logger.warning("Total de blocos inválido de %s (%s); descartado.", peer_id, total)
+            return
+        mask = int.from_bytes(base64.b64decode(bitmap_b64), 'little')
+        if mask.bit_length() > (self.total_block_count or total):
+            self.logger.warning("Bitmap de %s excede o total de blocos; descartado.", peer_id)
+            return
+        if self.total_block_count == 0 and total:
+            self.total_block_count = total
+            self._have_bitmap_cache = None
+            self.all_block_ids = [f"{self.file_name}_{i}" for i in range(total)]
+            self._block_index = {bid: i for i, bid in enumerate(self.all_block_ids)}
+            self._id_by_index = {i: bid for i, bid in enumerate(self.all_block_ids)}
+            if len(self.my_blocks) == total:
+                self._complete_event.set()
+        self._set_peer_mask(peer_id, mask)
+
+    def add_peer_blocks(self, peer_id: str, block_ids: List[str]):
+        """Acrescenta blocos à posse conhecida de um peer (delta de have)."""
+        mask = self._peer_masks.get(peer_id, 0)
+        for block_id in block_ids:
+            mask |= 1 << self._index_of(block_id)
+        self._set_peer_mask(peer_id, mask)
+
+    def _set_peer_mask(self, peer_id: str, mask: int):
+        """Substitui a máscara de um peer, ajustando a raridade pelo delta.
+
+        Só os bits que mudaram (XOR entre a máscara antiga e a nova) tocam
+        os contadores; um have repetido custa uma comparação de inteiros.
+        """
+        old = self._peer_masks.get(peer_id, 0)
+        if old == mask:
+            return
+        if mask:
+            self._peer_masks[peer_id] = mask
+        else:
+            self._peer_masks.pop(peer_id, None)
+        changed = old ^ mask
+        counts = self._rarity_counts
+        for idx in self._iter_bits(changed & mask):
+            counts[idx] = counts.get(idx, 0) + 1
+        for idx in self._iter_bits(changed & old):
+            remaining = counts.get(idx, 0) - 1
+            if remaining > 0:
+                counts[idx] = remaining
+            else:
+                counts.pop(idx, None)
+
+    def _missing_mask(self) -> int:
+        """Máscara dos blocos ausentes (bits ligados = faltando)."""
+        if not self.all_block_ids:
+            return 0
+        full_mask = (1 << self.total_block_count) - 1
+        return full_mask & ~self._have_mask
+
+    def iter_missing_blocks(self):
+        """Itera os IDs dos blocos ausentes sem materializar o conjunto."""
+        return (self._id_by_index[i] for i in self._iter_bits(self._missing_mask()))
 
     def get_missing_blocks(self) -> Set[str]:
         """Retorna os IDs dos blocos que faltam para completar o arquivo."""
-        if not self.all_block_ids:
-            return set()
-        return set(self.all_block_ids) - self.get_my_blocks()
-    
+        return set(self.iter_missing_blocks())
+
+    def get_missing_count(self) -> int:
+        """Conta os blocos ausentes (popcount, sem materializar ids)."""
+        return self._missing_mask().bit_count()
+
     def is_complete(self) -> bool:
         """Verifica se o peer possui todos os blocos do arquivo."""
-        if self.total_block_count == 0 and len(self.all_block_ids) > 0:
-             self.total_block_count = len(self.all_block_ids)
+        return self._complete_event.is_set()
+
+    def wait_complete(self, timeout: Optional[float] = None) -> bool:
+        """Bloqueia até o arquivo estar completo (ou o timeout expirar)."""
+        return self._complete_event.wait(timeout)
 
-        return len(self.my_blocks) > 0 and len(self.my_blocks) == self.total_block_count
-    
     def reconstruct_file(self):
         """Monta o arquivo final a partir dos blocos baixados."""
         if not self.is_complete():
@@ -76,18 +295,37 @@ class BlockManager:
             return
 
         output_path = os.path.join(self.download_dir, self.file_name)
-        self.logger.info(f"Reconstruindo arquivo em '{output_path}'...")
-        
-        # Ordena os blocos pelo seu índice numérico
-        sorted_block_ids = sorted(self.my_blocks.keys(), key=lambda x: int(x.split('_')[-1]))
+        self.logger.info("Reconstruindo arquivo em '%s'...", output_path)
+
+        # all_block_ids já está em ordem de índice: com o arquivo
+        # completo, nenhuma ordenação é necessária aqui
+        sorted_block_ids = self.all_block_ids or sorted(self.my_blocks.keys(), key=self._index_of)
+        buffers = [self.my_blocks[bid] for bid in sorted_block_ids]
 
         try:
-            with open(output_path, 'wb') as f:
-                for block_id in sorted_block_ids:
-                    f.write(self.my_blocks[block_id])
-            self.logger.info(f"Arquivo '{self.file_name}' reconstruído com sucesso.")
-        except IOError as e:
-            self.logger.error(f"Erro ao escrever arquivo reconstruído: {e}")
+            if self._slab is not None:
+                # Blocos já contíguos e em ordem no slab: uma escrita só
+                total_size = sum(len(buf) for buf in buffers)
+                with open(output_path, 'wb') as f:
+                    f.write(memoryview(self._slab)[:total_size])
+            elif hasattr(os, 'writev'):
+                # Uma syscall por lote de blocos, em vez de um write por bloco
+                fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    # Reserva o tamanho final de uma vez: evita a extensão
+                    # incremental de extents a cada lote escrito
+                    total_size = sum(len(buf) for buf in buffers)
+                    os.ftruncate(fd, total_size)
+                    for i in range(0, len(buffers), _IOV_MAX):
+                        os.writev(fd, buffers[i:i + _IOV_MAX])
+                finally:
+                    os.close(fd)
+            else:
+                with open(output_path, 'wb') as f:
+                    f.writelines(buffers)
+            self.logger.info("Arquivo '%s' reconstruído com sucesso.", self.file_name)
+        except OSError as e:
+            self.logger.error("Erro ao escrever arquivo reconstruído: %s", e)
 
     # --- Lógica de Rastreamento de Raridade ---
 
@@ -96,55 +334,65 @@ class BlockManager:
         # Se for a primeira vez que vemos os blocos deste peer, inicializa total_block_count
         if self.total_block_count == 0 and their_blocks:
             self.total_block_count = len(their_blocks)
-            self.all_block_ids = sorted(list(their_blocks), key=lambda x: int(x.split('_')[-1]))
-
-        # Remove o peer de todos os blocos que ele não tem mais
-        for block_id, peers in self.peer_block_map.items():
-            if peer_id in peers and block_id not in their_blocks:
-                peers.remove(peer_id)
-        
-        # Adiciona o peer aos novos blocos
+            self._have_bitmap_cache = None
+            self.all_block_ids = sorted(list(their_blocks), key=self._index_of)
+            if len(self.my_blocks) == self.total_block_count:
+                self._complete_event.set()
+
+        # A posse inteira do peer vira uma única máscara, substituída de uma vez
+        mask = 0
         for block_id in their_blocks:
-            if block_id not in self.peer_block_map:
-                self.peer_block_map[block_id] = set()
-            self.peer_block_map[block_id].add(peer_id)
-            
+            mask |= 1 << self._index_of(block_id)
+        self._set_peer_mask(peer_id, mask)
+
     def remove_peer_blocks(self, peer_id: str):
         """Remove todas as informações de blocos de um peer desconectado."""
-        for peers in self.peer_block_map.values():
-            if peer_id in peers:
-                peers.remove(peer_id)
+        self._set_peer_mask(peer_id, 0)
 
     def get_block_rarity(self) -> Dict[str, int]:
-        """Calcula a raridade de cada bloco (quantos peers o têm)."""
-        return {block_id: len(peers) for block_id, peers in self.peer_block_map.items()}
+        """Retorna a raridade de cada bloco (quantos peers o têm).
+
+        Leitura direta dos contadores incrementais: nenhum recálculo sobre
+        as máscaras de todos os peers por chamada.
+        """
+        return {self._id_by_index[idx]: n for idx, n in self._rarity_counts.items()}
 
-    def get_rarest_missing_blocks(self) -> List[str]:
-        """Retorna uma lista de blocos ausentes, do mais raro para o mais comum."""
-        missing = self.get_missing_blocks()
-        if not missing:
+    def get_rarest_missing_blocks(self, limit: Optional[int] = None) -> List[str]:
+        """Retorna blocos ausentes, do mais raro para o mais comum.
+
+        Com limit, usa um heap parcial (nsmallest) em vez de ordenar
+        todos os ausentes: quem só consegue requisitar k blocos por vez
+        não paga a ordenação do arquivo inteiro no início do download.
+        """
+        missing_mask = self._missing_mask()
+        if not missing_mask:
             return []
-            
+
         rarity = self.get_block_rarity()
-        # Ordena os blocos ausentes pela sua raridade (menor primeiro)
         # O valor default 0 para raridade significa que nenhum peer conhecido o tem
-        return sorted(list(missing), key=lambda block: rarity.get(block, 0))
+        key = lambda block: rarity.get(block, 0)
+        missing = (self._id_by_index[i] for i in self._iter_bits(missing_mask))
+        if limit is not None and limit < missing_mask.bit_count():
+            return heapq.nsmallest(limit, missing, key=key)
+        return sorted(missing, key=key)
+
+    def get_peers_with_block(self, block_id: str) -> Set[str]:
+        """Retorna os peers que sabemos possuir um bloco específico."""
+        bit = 1 << self._index_of(block_id)
+        return {pid for pid, mask in self._peer_masks.items() if mask & bit}
 
     def get_peer_blocks(self, peer_id: str) -> Set[str]:
         """Retorna o conjunto de blocos que um peer específico é conhecido por ter."""
-        peer_blocks = set()
-        for block_id, peers_with_block in self.peer_block_map.items():
-            if peer_id in peers_with_block:
-                peer_blocks.add(block_id)
-        return peer_blocks
+        mask = self._peer_masks.get(peer_id, 0)
+        return {self._id_by_index[i] for i in self._iter_bits(mask)}
 
     def get_status_string(self) -> str:
         """Retorna uma string formatada com o status atual do download."""
         if self.total_block_count == 0:
             return "Status: idle | Aguardando informações do arquivo..."
-        
+
         progress = (len(self.my_blocks) / self.total_block_count) * 100
         status = "completed" if self.is_complete() else "downloading"
-        
+
         return (f"Status: {status} | Progresso: {progress:.1f}% | "
-                f"{len(self.my_blocks)}/{self.total_block_count} blocos")
\ No newline at end of file
+                f"{len(self.my_blocks)}/{self.total_block_count} blocos")
@@ -1,21 +1,49 @@
 import socket
+import selectors
 import threading
 import time
 import uuid
 import logging
 import os
-import json
 import random
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Set, Optional, Tuple
 
 from .block_manager import BlockManager
 from .unchoke_manager import UnchokeManager
 from .peer_connection import PeerConnection
+from .protocol import create_message, recv_message, send_message, tune_socket
 
 class Peer:
     """
     Implementação do nó (peer) que compartilha e baixa arquivos.
     """
+    # Janela de requisições em voo por peer: mantém o pipeline cheio em
+    # vez de um bloco por tick de 5s. A janela começa neste valor e se
+    # adapta por peer (AIMD): cresce de um em um enquanto o peer drena a
+    # janela cheia dentro do prazo, cai pela metade quando um pedido dele
+    # estoura o REQUEST_TTL
+    MAX_INFLIGHT_PER_PEER = 16
+    MIN_INFLIGHT_PER_PEER = 4
+    MAX_INFLIGHT_CAP = 64
+    # Uma requisição sem resposta é repetida após este prazo
+    REQUEST_TTL = 10.0
+    # Modo endgame: com poucos blocos faltando, pede cada um a todos os
+    # peers desbloqueados que o tenham, para não esperar um peer lento
+    ENDGAME_THRESHOLD = 10
+    # Limites do cache de peers conhecidos: em enxames grandes, a lista
+    # não cresce sem teto nem acumula peers que o tracker parou de citar
+    MAX_KNOWN_PEERS = 256
+    KNOWN_PEER_TTL = 120.0
+    # Janela de coalescência dos anúncios de posse: uma rajada de blocos
+    # vira um único have_delta + um único sync com o tracker
+    HAVE_DEBOUNCE = 0.25
+    # Frames de block_data (cabeçalho serializado, sem o payload) ficam
+    # em cache: a estratégia rarest-first faz o mesmo bloco ser pedido
+    # por vários peers em sequência
+    BLOCK_FRAME_CACHE_SIZE = 256
+
     def __init__(self, tracker_host, tracker_port, listen_port=0):
         self.peer_id = f"Peer-{uuid.uuid4().hex[:6]}"
         self.logger = logging.getLogger(self.peer_id)
@@ -31,14 +59,69 @@ class Peer:
         # Estrutura: {peer_id: PeerConnection}
         self.connections: Dict[str, PeerConnection] = {}
         self.connections_lock = threading.Lock()
+
+        # Reator de leitura: um único select/epoll atende todas as
+        # conexões, em vez de uma thread leitora bloqueada por peer
+        self._selector = selectors.DefaultSelector()
         
-        # Estrutura: {peer_id: {'address': (ip, port), 'blocks': {block_ids}}}
-        self.known_peers_info: Dict[str, Dict] = {}
+        # Estrutura: {peer_id: {'address': (ip, port), 'last_seen': ts}},
+        # em ordem LRU (o mais recentemente citado pelo tracker no fim)
+        self.known_peers_info: 'OrderedDict[str, Dict]' = OrderedDict()
         self.known_peers_lock = threading.Lock()
 
         self.running = False
         self.download_task: Optional[Dict] = None
 
+        # Requisições em voo: {peer_id: {block_ids pedidos e não recebidos}}
+        self._inflight: Dict[str, Set[str]] = {}
+        # Quando cada bloco foi requisitado: {block_id: timestamp}; evita
+        # pedidos duplicados até o prazo REQUEST_TTL expirar
+        self._requested: Dict[str, float] = {}
+        # Tamanho atual da janela AIMD de cada peer (ausente = inicial)
+        self._window: Dict[str, int] = {}
+        self._inflight_lock = threading.Lock()
+
+        # Últimos blocos aceitos: as cópias extras que o fan-out do
+        # endgame gera são descartadas antes de tocar o BlockManager
+        self._recent_blocks = deque(maxlen=256)
+        self._recent_blocks_set: Set[str] = set()
+
+        # Bytes recebidos recentemente por peer (com decaimento): guia a
+        # escolha de quem pedir um bloco quando há vários candidatos
+        self._upload_score: Dict[str, int] = {}
+
+        # Acorda o tick de gerenciamento antes da hora quando algo
+        # acionável acontece (peer novo do tracker, parada)
+        self._mgmt_event = threading.Event()
+
+        # Anúncios de posse pendentes, coalescidos por HAVE_DEBOUNCE
+        self._pending_have: Set[str] = set()
+        self._have_timer: Optional[threading.Timer] = None
+        self._have_lock = threading.Lock()
+
+        # Cache LRU dos frames de block_data já serializados: servir o
+        # mesmo bloco a N peers codifica o cabeçalho uma vez só (o
+        # payload segue cru e já é uma fatia sem cópia)
+        self._block_frame_cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self._block_frame_lock = threading.Lock()
+
+        # Pool limitado para tarefas curtas (handshakes de entrada e
+        # conexões de saída): nada de criar uma thread nova por evento,
+        # nem de deixar o número de threads crescer sem teto. O teto
+        # acompanha os cores disponíveis (cgroups/affinity incluídos)
+        try:
+            cpus = len(os.sched_getaffinity(0))
+        except AttributeError:
+            cpus = os.cpu_count() or 4
+        self._pool = ThreadPoolExecutor(max_workers=max(8, 2 * cpus),
+                                        thread_name_prefix=self.peer_id)
+
+        # Conexão persistente com o tracker (criada sob demanda): evita um
+        # handshake TCP + thread nova no tracker a cada comando
+        self._tracker_sock: Optional[socket.socket] = None
+        self._tracker_lock = threading.Lock()
+        self._tracker_rxbuf = bytearray(65536)
+
     def start(self):
         """Inicia o servidor do peer para aceitar conexões de outros."""
         if self.running:
@@ -51,18 +134,20 @@ class Peer:
         # Pega a porta real caso 0 tenha sido usado
         self.listen_port = self.server_socket.getsockname()[1] 
         self.server_socket.listen(10)
-        self.logger.info(f"Escutando na porta {self.listen_port}")
+        self.logger.info("Escutando na porta %s", self.listen_port)
         
         self.server_thread = threading.Thread(target=self._accept_connections, daemon=True)
         self.server_thread.start()
         
         # Inicia threads de background para gerenciamento
+        threading.Thread(target=self._reactor, daemon=True).start()
         threading.Thread(target=self._manage_connections_and_requests, daemon=True).start()
         threading.Thread(target=self._run_unchoke_logic, daemon=True).start()
 
     def stop(self):
         """Para todas as operações do peer."""
         self.running = False
+        self._mgmt_event.set()
         if self.server_socket:
             self.server_socket.close()
         
@@ -71,6 +156,15 @@ class Peer:
                 conn.close()
             self.connections.clear()
         
+        with self._tracker_lock:
+            self._close_tracker_conn()
+        try:
+            self._selector.close()
+        except OSError:
+            pass
+        self._pool.shutdown(wait=False)
+        if self.block_manager:
+            self.block_manager.close()
         self.logger.info("Peer parado.")
 
     def share_file(self, file_path: str, block_size=16384): # 16KB
@@ -79,7 +173,7 @@ class Peer:
         self.block_manager = BlockManager(file_name, block_size, self.logger)
         self.block_manager.load_from_file(file_path)
         
-        self.logger.info(f"Compartilhando arquivo '{file_name}' com {self.block_manager.total_block_count} blocos.")
+        self.logger.info("Compartilhando arquivo '%s' com %s blocos.", file_name, self.block_manager.total_block_count)
         
         # Registra no tracker
         self._register_with_tracker()
@@ -88,11 +182,11 @@ class Peer:
         """Configura o peer para ser um leecher de um arquivo."""
         self.download_task = {"file_name": file_name}
         self.block_manager = BlockManager(file_name, block_size, self.logger)
-        self.logger.info(f"Preparando para baixar o arquivo '{file_name}'.")
+        self.logger.info("Preparando para baixar o arquivo '%s'.", file_name)
 
         # Registra no tracker (com 0 blocos) e obtém a lista de peers
         self._register_with_tracker()
-        self._update_peers_from_tracker()
+        self._sync_with_tracker()
 
     def is_download_complete(self):
         """Verifica se o download foi concluído."""
@@ -100,6 +194,12 @@ class Peer:
             return False
         return self.block_manager.is_complete()
 
+    def wait_download_complete(self, timeout: Optional[float] = None) -> bool:
+        """Bloqueia até o download terminar, sem polling."""
+        if not self.block_manager:
+            return False
+        return self.block_manager.wait_complete(timeout)
+
     # --- Métodos de Rede Internos ---
 
     def _accept_connections(self):
@@ -107,22 +207,26 @@ class Peer:
         while self.running:
             try:
                 conn_socket, addr = self.server_socket.accept()
-                self.logger.info(f"Conexão de entrada de {addr}")
+                self.logger.info("Conexão de entrada de %s", addr)
                 # A conexão será gerenciada após a troca de mensagem 'handshake'
-                threading.Thread(target=self._handle_incoming_connection, args=(conn_socket,), daemon=True).start()
+                self._pool.submit(self._handle_incoming_connection, conn_socket)
             except OSError:
                 break
 
     def _handle_incoming_connection(self, conn_socket: socket.socket):
         """Lida com a primeira mensagem de uma nova conexão para identificá-la."""
         try:
+            # Prazo para o handshake: uma conexão muda não pode prender
+            # um worker do pool (compartilhado com as conexões de saída)
+            # para sempre; o timeout estoura o read_message e fecha
+            conn_socket.settimeout(5)
             # A primeira mensagem deve ser um 'handshake' para identificar o peer
             peer_conn = PeerConnection(address=conn_socket.getpeername(), sock=conn_socket, logger=self.logger)
             msg = peer_conn.read_message()
 
             if msg and msg.get('type') == 'handshake':
                 incoming_peer_id = msg['peer_id']
-                self.logger.info(f"Handshake recebido de {incoming_peer_id}")
+                self.logger.info("Handshake recebido de %s", incoming_peer_id)
 
                 # Responde com nosso handshake
                 peer_conn.send_message({'type': 'handshake', 'peer_id': self.peer_id})
@@ -131,14 +235,14 @@ class Peer:
                 with self.connections_lock:
                     self.connections[incoming_peer_id] = peer_conn
 
-                # Inicia o loop de mensagens para esta nova conexão
-                peer_conn.send_message({'type': 'have', 'blocks': list(self.block_manager.get_my_blocks())})
-                self._message_loop(peer_conn, incoming_peer_id)
+                # Entrega a conexão ao reator de leitura
+                peer_conn.send_message(self._make_have_message())
+                self._register_with_reactor(incoming_peer_id, peer_conn)
             else:
                 self.logger.warning("Conexão de entrada sem handshake. Fechando.")
                 conn_socket.close()
         except Exception as e:
-            self.logger.error(f"Erro ao lidar com conexão de entrada: {e}")
+            self.logger.error("Erro ao lidar com conexão de entrada: %s", e)
             conn_socket.close()
             
     def _connect_to_peer(self, peer_id: str, address: Tuple[str, int]):
@@ -148,7 +252,7 @@ class Peer:
                 return # Já conectado
 
         try:
-            self.logger.info(f"Tentando conectar ao peer {peer_id} em {address}...")
+            self.logger.info("Tentando conectar ao peer %s em %s...", peer_id, address)
             peer_conn = PeerConnection(address=address, logger=self.logger)
             if not peer_conn.connect():
                 return
@@ -164,142 +268,365 @@ class Peer:
             with self.connections_lock:
                 self.connections[peer_id] = peer_conn
             
-            # Solicita os blocos que ele tem
-            peer_conn.send_message({'type': 'have', 'blocks': list(self.block_manager.get_my_blocks())})
+            # Anuncia os blocos que temos
+            peer_conn.send_message(self._make_have_message())
 
-            threading.Thread(target=self._message_loop, args=(peer_conn, peer_id), daemon=True).start()
-            self.logger.info(f"Conexão estabelecida com {peer_id}")
+            self._register_with_reactor(peer_id, peer_conn)
+            self.logger.info("Conexão estabelecida com %s", peer_id)
 
         except Exception as e:
-            self.logger.error(f"Falha ao conectar ao peer {peer_id}: {e}")
-
-    def _message_loop(self, peer_conn: PeerConnection, peer_id: str):
-        """Loop para processar mensagens de um peer específico."""
-        while self.running and peer_conn.is_connected():
+            self.logger.error("Falha ao conectar ao peer %s: %s", peer_id, e)
+
+    def _register_with_reactor(self, peer_id: str, peer_conn: PeerConnection):
+        """Registra uma conexão pronta (handshake feito) no reator."""
+        # Remove o timeout de conexão: o select decide quando há o que
+        # ler e a thread escritora continua com semântica bloqueante
+        peer_conn.socket.settimeout(None)
+        self._selector.register(peer_conn.socket, selectors.EVENT_READ, (peer_id, peer_conn))
+
+    def _reactor(self):
+        """Loop único de leitura para todas as conexões de peers.
+
+        Um select/epoll acorda apenas quando algum socket tem dados;
+        os bytes vão para o parser incremental da conexão e cada
+        mensagem completa é despachada. Substitui as N threads leitoras
+        bloqueadas (uma por peer) que disputavam o GIL.
+        """
+        # Aliases locais: LOAD_FAST em vez de cadeias de atributos no
+        # laço executado por evento de socket
+        select = self._selector.select
+        handle_message = self._handle_peer_message
+        cleanup = self._cleanup_connection
+        # Buffer de recepção único do reator (uma thread só): recv_into
+        # evita alocar um bytes novo a cada drenagem de socket
+        rxbuf = bytearray(65536)
+        rxview = memoryview(rxbuf)
+        while self.running:
             try:
-                msg = peer_conn.read_message()
-                if not msg:
-                    break # Conexão fechada
-
-                msg_type = msg.get('type')
-
-                if msg_type == 'have':
-                    # Atualiza o que sabemos sobre os blocos do outro peer
-                    self.block_manager.update_peer_blocks(peer_id, set(msg['blocks']))
-
-                elif msg_type == 'request_block':
-                    if self.unchoke_manager.is_unchoked(peer_id):
-                        block_id = msg['block_id']
-                        data = self.block_manager.get_block_data(block_id)
-                        if data:
-                            self.logger.info(f"Enviando bloco '{block_id}' para {peer_id}")
-                            peer_conn.send_message({'type': 'block_data', 'block_id': block_id, 'data': data.hex()})
-
-                elif msg_type == 'block_data':
-                    block_id = msg['block_id']
-                    data = bytes.fromhex(msg['data'])
-                    if self.block_manager.add_block(block_id, data):
-                        # Informa a todos que agora temos este bloco
-                        self._broadcast_have_update()
-                        # Se completou, reconstrói o arquivo
-                        if self.block_manager.is_complete():
-                            self.block_manager.reconstruct_file()
-                            self.logger.info("="*50)
-                            self.logger.info(f"DOWNLOAD COMPLETO! Arquivo '{self.block_manager.file_name}' salvo em 'downloads/'.")
-                            self.logger.info("="*50)
-                            # Agora este peer se torna um seeder
-                            self.download_task = None
-                
-                elif msg_type == 'choke':
-                    self.logger.info(f"Recebido CHOKE de {peer_id}")
-                    peer_conn.set_choked_by_peer(True)
-                
-                elif msg_type == 'unchoke':
-                    self.logger.info(f"Recebido UNCHOKE de {peer_id}")
-                    peer_conn.set_choked_by_peer(False)
+                events = select(timeout=0.5)
+            except OSError:
+                continue
 
-            except (ConnectionResetError, BrokenPipeError):
-                self.logger.warning(f"Conexão com {peer_id} perdida.")
-                break
-            except Exception as e:
-                self.logger.error(f"Erro no loop de mensagens com {peer_id}: {e}")
-                break
-        
-        # Limpeza da conexão
+            if not events:
+                # Varredura: conexões fechadas pela thread escritora não
+                # geram evento de leitura; remove as que já morreram
+                for key in list(self._selector.get_map().values()):
+                    _, conn = key.data
+                    if not conn.is_connected():
+                        # O close() já zerou conn.socket; desregistra pelo
+                        # fileobj guardado na chave do selector
+                        try:
+                            self._selector.unregister(key.fileobj)
+                        except (KeyError, ValueError):
+                            pass
+                        self._cleanup_connection(*key.data)
+                continue
+
+            for key, _ in events:
+                peer_id, peer_conn = key.data
+                try:
+                    nbytes = key.fileobj.recv_into(rxbuf)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except (OSError, ConnectionResetError) as e:
+                    self.logger.warning("Conexão com %s perdida: %s", peer_id, e)
+                    cleanup(peer_id, peer_conn)
+                    continue
+
+                if not nbytes:
+                    cleanup(peer_id, peer_conn)
+                    continue
+
+                try:
+                    messages = peer_conn.feed(rxview[:nbytes])
+                except ValueError as e:
+                    self.logger.warning("Mensagem inválida de %s: %s. Fechando conexão.", peer_id, e)
+                    cleanup(peer_id, peer_conn)
+                    continue
+
+                for msg in messages:
+                    try:
+                        handle_message(peer_conn, peer_id, msg)
+                    except Exception as e:
+                        self.logger.error("Erro ao processar mensagem de %s: %s", peer_id, e)
+
+    def _handle_peer_message(self, peer_conn: PeerConnection, peer_id: str, msg: Dict):
+        """Despacha uma mensagem completa recebida de um peer."""
+        msg_type = msg.get('type')
+
+        if msg_type == 'have':
+            # Atualiza o que sabemos sobre os blocos do outro peer
+            self.block_manager.update_peer_bitmap(peer_id, msg['bitmap'], msg.get('total', 0))
+
+        elif msg_type in ('request_block', 'request_blocks'):
+            if self.unchoke_manager.is_unchoked(peer_id):
+                block_ids = msg.get('block_ids') or [msg['block_id']]
+                for block_id in block_ids:
+                    data = self.block_manager.get_block_data(block_id)
+                    if data:
+                        self.logger.debug("Enviando bloco '%s' para %s", block_id, peer_id)
+                        # O bloco segue cru após o cabeçalho (aceita a
+                        # fatia de memoryview do seeder sem cópia); o
+                        # cabeçalho serializado sai do cache LRU, já que
+                        # rarest-first faz vários peers pedirem o mesmo
+                        # bloco em sequência
+                        frame = self._get_block_frame(block_id, len(data))
+                        peer_conn.send_raw(frame, payload=data)
+
+        elif msg_type == 'block_data':
+            block_id = msg['block_id']
+            data = msg['data']
+            with self._inflight_lock:
+                inflight = self._inflight.get(peer_id, set())
+                inflight.discard(block_id)
+                self._requested.pop(block_id, None)
+                # Aumento aditivo: se o peer drena a janela cheia dentro
+                # do prazo, ele aguenta mais pedidos em voo
+                window = self._window.get(peer_id, self.MAX_INFLIGHT_PER_PEER)
+                if len(inflight) >= window - 1 and window < self.MAX_INFLIGHT_CAP:
+                    self._window[peer_id] = window + 1
+            self._upload_score[peer_id] = self._upload_score.get(peer_id, 0) + len(data)
+            self.unchoke_manager.record_block_received(peer_id, len(data))
+            if block_id in self._recent_blocks_set:
+                self.logger.debug("Bloco '%s' duplicado de %s descartado.", block_id, peer_id)
+                return
+            if self.block_manager.add_block(block_id, data, msg.get('sha256')):
+                self._note_recent_block(block_id)
+                # Acumula o anúncio; a rajada inteira sai num delta só
+                self._queue_have_announce(block_id)
+                # Se completou, reconstrói o arquivo
+                if self.block_manager.is_complete():
+                    self._flush_have()
+                    self.block_manager.reconstruct_file()
+                    self.logger.info("="*50)
+                    self.logger.info("DOWNLOAD COMPLETO! Arquivo '%s' salvo em 'downloads/'.", self.block_manager.file_name)
+                    self.logger.info("="*50)
+                    # Agora este peer se torna um seeder
+                    self.download_task = None
+            # Reabastece a janela de requisições imediatamente
+            if self.download_task:
+                self._request_blocks()
+
+        elif msg_type == 'have_delta':
+            self.block_manager.add_peer_blocks(peer_id, msg['add'])
+
+        elif msg_type == 'choke':
+            self.logger.info("Recebido CHOKE de %s", peer_id)
+            peer_conn.set_choked_by_peer(True)
+
+        elif msg_type == 'unchoke':
+            self.logger.info("Recebido UNCHOKE de %s", peer_id)
+            peer_conn.set_choked_by_peer(False)
+            # Aproveita o unchoke na hora, sem esperar o próximo tick
+            if self.download_task:
+                self._request_blocks()
+
+    def _get_block_frame(self, block_id: str, payload_len: int) -> bytes:
+        """Retorna o frame serializado de block_data de um bloco.
+
+        O conteúdo de um bloco é imutável depois de adquirido, então o
+        cabeçalho (tipo, id, digest, payload_len) é sempre o mesmo:
+        serializa uma vez e reusa do cache LRU nos próximos pedidos.
+        """
+        with self._block_frame_lock:
+            frame = self._block_frame_cache.get(block_id)
+            if frame is not None:
+                self._block_frame_cache.move_to_end(block_id)
+                return frame
+        frame = create_message({'type': 'block_data', 'block_id': block_id,
+                                'sha256': self.block_manager.get_block_digest(block_id),
+                                'payload_len': payload_len})
+        with self._block_frame_lock:
+            self._block_frame_cache[block_id] = frame
+            self._block_frame_cache.move_to_end(block_id)
+            while len(self._block_frame_cache) > self.BLOCK_FRAME_CACHE_SIZE:
+                self._block_frame_cache.popitem(last=False)
+        return frame
+
+    def _cleanup_connection(self, peer_id: str, peer_conn: PeerConnection):
+        """Desregistra e limpa uma conexão encerrada."""
+        if peer_conn.socket is not None:
+            try:
+                self._selector.unregister(peer_conn.socket)
+            except (KeyError, ValueError):
+                pass
         peer_conn.close()
         with self.connections_lock:
-            if peer_id in self.connections:
+            if self.connections.get(peer_id) is peer_conn:
                 del self.connections[peer_id]
         with self.known_peers_lock:
             if peer_id in self.known_peers_info:
                 del self.known_peers_info[peer_id]
+        # Blocos em voo deste peer voltam a ser elegíveis para requisição
+        with self._inflight_lock:
+            for block_id in self._inflight.pop(peer_id, ()):
+                self._requested.pop(block_id, None)
+            self._window.pop(peer_id, None)
+        self._upload_score.pop(peer_id, None)
         self.block_manager.remove_peer_blocks(peer_id)
         self.unchoke_manager.unregister_peer(peer_id)
-        self.logger.info(f"Conexão com {peer_id} finalizada e limpa.")
+        self.logger.info("Conexão com %s finalizada e limpa.", peer_id)
+
+    def _note_recent_block(self, block_id: str):
+        """Registra um bloco no anel de duplicatas recentes."""
+        if len(self._recent_blocks) == self._recent_blocks.maxlen:
+            self._recent_blocks_set.discard(self._recent_blocks[0])
+        self._recent_blocks.append(block_id)
+        self._recent_blocks_set.add(block_id)
 
     # --- Lógica de Gerenciamento e Estratégia ---
 
     def _manage_connections_and_requests(self):
         """Thread periódica para conectar a novos peers e solicitar blocos."""
-        last_status_log_time = 0
+        # Relógio monotônico (imune a ajustes do relógio de parede) lido
+        # uma vez por tick e reutilizado em todas as comparações
+        last_status_log_time = 0.0
+        last_full_have_time = time.monotonic()
         while self.running:
-            time.sleep(5)
-            # Atualiza a lista de peers do tracker periodicamente
+            # Dorme até o próximo tick, mas acorda na hora se surgir
+            # trabalho novo (em vez de um sleep fixo)
+            self._mgmt_event.wait(5)
+            self._mgmt_event.clear()
+            if not self.running:
+                break
+            # Atualiza nossos blocos e a lista de peers em uma única ida
             if self.download_task:
-                 self._update_peers_from_tracker()
+                 self._sync_with_tracker()
 
             # Conectar a novos peers da lista do tracker
             with self.known_peers_lock:
                 all_known_peers = self.known_peers_info.copy()
             
+            # Snapshot real (não uma view viva): o pool pode inserir
+            # conexões enquanto iteramos fora do lock
             with self.connections_lock:
-                connected_peers = self.connections.keys()
+                connected_peers = set(self.connections.keys())
 
             for peer_id, info in all_known_peers.items():
                 if peer_id not in connected_peers:
-                    self._connect_to_peer(peer_id, info['address'])
+                    # Conexões de saída em paralelo no pool: um peer que
+                    # demora a responder não atrasa o tick inteiro
+                    self._pool.submit(self._connect_to_peer, peer_id, info['address'])
+
+            self._prune_known_peers()
 
             # Solicitar blocos dos peers que nos deram unchoke
             if self.download_task:
                 self._request_blocks()
+
+            # Decaimento: desempenho antigo pesa cada vez menos na escolha
+            for pid in list(self._upload_score):
+                self._upload_score[pid] //= 2
             
+            now = time.monotonic()
             # Exibir status do download a cada 10s
-            if time.time() - last_status_log_time > 10:
+            if now - last_status_log_time > 10:
                 if self.block_manager and self.download_task:
                     self.logger.info(self.block_manager.get_status_string())
-                    last_status_log_time = time.time()
+                    last_status_log_time = now
+
+            # Reanuncia a posse completa de tempos em tempos, como resync
+            # dos deltas incrementais
+            if now - last_full_have_time > 30:
+                if self.block_manager:
+                    self._broadcast_have_update()
+                    last_full_have_time = now
 
     def _request_blocks(self):
-        """Implementa a lógica 'rarest first' para solicitar blocos."""
+        """Implementa 'rarest first' com uma janela de requisições em voo.
+
+        Mantém uma janela de pedidos pendentes por peer desbloqueado
+        (tamanho adaptado por AIMD, ver as constantes de inflight),
+        reabastecida a cada block_data recebido.
+        Um bloco já requisitado só é pedido de novo após REQUEST_TTL ou,
+        na reta final (endgame), a todos os peers que o tenham de uma vez.
+        """
         if not self.block_manager or self.block_manager.is_complete():
             return
-            
-        rarest_missing_blocks = self.block_manager.get_rarest_missing_blocks()
+
+        with self.connections_lock:
+            peer_ids = list(self.connections)
+        # Não adianta classificar mais blocos do que cabem nas janelas
+        with self._inflight_lock:
+            window_capacity = sum(self._window.get(pid, self.MAX_INFLIGHT_PER_PEER)
+                                  for pid in peer_ids) or self.MAX_INFLIGHT_PER_PEER
+        rarest_missing_blocks = self.block_manager.get_rarest_missing_blocks(limit=window_capacity)
         if not rarest_missing_blocks:
             return
 
+        total = self.block_manager.total_block_count
+        # O gatilho usa a contagem real de ausentes, não a lista (que é
+        # truncada pela capacidade das janelas e ativaria o endgame
+        # desde o primeiro tick em arquivos grandes)
+        endgame = self.block_manager.get_missing_count() <= max(
+            self.ENDGAME_THRESHOLD, int(total * 0.05))
+
         with self.connections_lock:
             connections_copy = self.connections.copy()
 
+        now = time.monotonic()
+        had_pending = False
+        # Pedidos acumulados por peer: um único request_blocks por peer
+        # por rodada, em vez de uma mensagem por bloco
+        batches: Dict[str, list] = {}
+
         for block_id in rarest_missing_blocks:
+            with self._inflight_lock:
+                requested_at = self._requested.get(block_id)
+            if requested_at is not None and now - requested_at < self.REQUEST_TTL:
+                had_pending = True
+                if not endgame:
+                    continue
+            elif requested_at is not None:
+                # Diminuição multiplicativa: quem segurava o pedido que
+                # estourou o prazo passa a receber uma janela menor. A
+                # entrada vencida também sai da janela dele — senão o
+                # slot ficaria ocupado por um fantasma até a desconexão
+                with self._inflight_lock:
+                    for pid, inflight in self._inflight.items():
+                        if block_id in inflight:
+                            inflight.discard(block_id)
+                            window = self._window.get(pid, self.MAX_INFLIGHT_PER_PEER)
+                            self._window[pid] = max(self.MIN_INFLIGHT_PER_PEER, window // 2)
+
             candidate_peers = []
-            with self.known_peers_lock:
-                # Usa o block_manager para saber quem tem o bloco
-                peers_with_block = self.block_manager.peer_block_map.get(block_id, set())
-                for peer_id in peers_with_block:
-                    if peer_id in connections_copy and not connections_copy[peer_id].is_choked_by_peer():
+            for peer_id in self.block_manager.get_peers_with_block(block_id):
+                if peer_id not in connections_copy or connections_copy[peer_id].is_choked_by_peer():
+                    continue
+                with self._inflight_lock:
+                    inflight = self._inflight.setdefault(peer_id, set())
+                    if endgame or len(inflight) < self._window.get(peer_id, self.MAX_INFLIGHT_PER_PEER):
                         candidate_peers.append(peer_id)
             
-            if candidate_peers:
-                chosen_peer_id = random.choice(candidate_peers)
-                self.logger.info(f"Requisitando bloco (raro) '{block_id}' do peer {chosen_peer_id}")
-                connections_copy[chosen_peer_id].send_message({'type': 'request_block', 'block_id': block_id})
-                # Requisita um bloco por vez para não sobrecarregar
-                return
+            if not candidate_peers:
+                continue
+            if endgame:
+                # Fan-out: o primeiro peer a responder encerra a espera
+                with self._inflight_lock:
+                    chosen = [pid for pid in candidate_peers
+                              if block_id not in self._inflight.get(pid, ())]
+            else:
+                # Prefere quem tem nos servido mais rápido; o componente
+                # aleatório desempata e dá chance a peers novos
+                chosen = [max(candidate_peers,
+                              key=lambda pid: (self._upload_score.get(pid, 0), random.random()))]
+            for chosen_peer_id in chosen:
+                # setdefault: o reator pode ter limpado a entrada do peer
+                # (desconexão) entre a escolha e o registro do pedido
+                with self._inflight_lock:
+                    self._inflight.setdefault(chosen_peer_id, set()).add(block_id)
+                batches.setdefault(chosen_peer_id, []).append(block_id)
+            if chosen:
+                with self._inflight_lock:
+                    self._requested[block_id] = now
+
+        for chosen_peer_id, block_ids in batches.items():
+            self.logger.debug("Requisitando %s blocos do peer %s", len(block_ids), chosen_peer_id)
+            connections_copy[chosen_peer_id].send_message({'type': 'request_blocks', 'block_ids': block_ids})
         
         # Log se nenhum bloco puder ser requisitado
-        if rarest_missing_blocks:
-            self.logger.info(f"Faltam {len(rarest_missing_blocks)} blocos, mas não há peers desbloqueados para pedi-los agora.")
+        if not batches and not had_pending:
+            self.logger.info("Faltam %s blocos, mas não há peers desbloqueados para pedi-los agora.", len(rarest_missing_blocks))
 
     def _run_unchoke_logic(self):
         """Thread periódica que executa a lógica de tit-for-tat."""
@@ -326,7 +653,7 @@ class Peer:
                 self.logger.info("Nenhum peer interessado encontrado.")
                 continue
 
-            self.logger.info(f"Peers interessados encontrados: {interested_peers}")
+            self.logger.info("Peers interessados encontrados: %s", interested_peers)
             
             # Pede ao UnchokeManager para decidir quem desbloquear
             choke_list, unchoke_list = self.unchoke_manager.evaluate_peers(
@@ -334,91 +661,189 @@ class Peer:
                 self.block_manager.get_block_rarity()
             )
 
-            # Envia as mensagens de choke/unchoke
+            # Envia as mensagens de choke/unchoke (envios fora do lock: um
+            # peer lento não pode travar quem precisa do connections_lock)
             with self.connections_lock:
-                for peer_id in unchoke_list:
-                    if peer_id in self.connections:
-                        self.logger.info(f"Enviando UNCHOKE para: {peer_id}")
-                        self.connections[peer_id].send_message({'type': 'unchoke'})
-                for peer_id in choke_list:
-                    if peer_id in self.connections:
-                        self.logger.info(f"Enviando CHOKE para: {peer_id}")
-                        self.connections[peer_id].send_message({'type': 'choke'})
+                unchoke_conns = [(pid, self.connections[pid]) for pid in unchoke_list if pid in self.connections]
+                choke_conns = [(pid, self.connections[pid]) for pid in choke_list if pid in self.connections]
+            for peer_id, conn in unchoke_conns:
+                self.logger.info("Enviando UNCHOKE para: %s", peer_id)
+                conn.send_message({'type': 'unchoke'})
+            for peer_id, conn in choke_conns:
+                self.logger.info("Enviando CHOKE para: %s", peer_id)
+                conn.send_message({'type': 'choke'})
+
+    def _make_have_message(self) -> Dict:
+        """Monta a mensagem 'have' com a posse atual como bitmap."""
+        bitmap, total = self.block_manager.get_have_bitmap()
+        return {'type': 'have', 'bitmap': bitmap, 'total': total}
+
+    def _queue_have_announce(self, block_id: str):
+        """Agenda o anúncio de um bloco novo, coalescendo rajadas.
+
+        Sob pipelining/endgame chegam vários blocos em poucos ms; cada um
+        custava um broadcast completo mais um sync com o tracker. Os ids
+        acumulam por HAVE_DEBOUNCE e saem em um único have_delta.
+        """
+        with self._have_lock:
+            self._pending_have.add(block_id)
+            if self._have_timer is None:
+                self._have_timer = threading.Timer(self.HAVE_DEBOUNCE, self._flush_have)
+                self._have_timer.daemon = True
+                self._have_timer.start()
+
+    def _flush_have(self):
+        """Envia em um único delta os anúncios acumulados."""
+        with self._have_lock:
+            if self._have_timer is not None:
+                self._have_timer.cancel()
+                self._have_timer = None
+            pending = list(self._pending_have)
+            self._pending_have.clear()
+        if pending:
+            self._broadcast_have_delta(pending)
+
+    def _broadcast_have_delta(self, block_ids):
+        """Anuncia apenas os blocos recém-obtidos aos peers conectados.
+
+        O custo por bloco novo passa de O(posse inteira) para O(1); o
+        resync periódico com o have completo cobre mensagens perdidas.
+        """
+        # Codifica uma única vez; todas as conexões enfileiram o mesmo frame
+        frame = create_message({'type': 'have_delta', 'add': list(block_ids)})
+        # Snapshot sob o lock; o sendall bloqueante acontece fora dele
+        with self.connections_lock:
+            targets = list(self.connections.values())
+        for conn in targets:
+            conn.send_raw(frame, droppable=True)
+        # Também atualiza o tracker (e aproveita a resposta com peers)
+        self._sync_with_tracker()
 
     def _broadcast_have_update(self):
         """Informa a todos os peers conectados sobre os blocos que possuímos."""
-        msg = {'type': 'have', 'blocks': list(self.block_manager.get_my_blocks())}
+        frame = create_message(self._make_have_message())
         with self.connections_lock:
-            for conn in self.connections.values():
-                conn.send_message(msg)
-        # Também atualiza o tracker
-        self._update_tracker_blocks()
+            targets = list(self.connections.values())
+        for conn in targets:
+            conn.send_raw(frame, droppable=True)
+        # Também atualiza o tracker (e aproveita a resposta com peers)
+        self._sync_with_tracker()
 
 
     # --- Comunicação com o Tracker ---
 
+    def _ensure_tracker_conn(self) -> socket.socket:
+        """Garante (criando se preciso) a conexão persistente com o tracker."""
+        if self._tracker_sock is None:
+            sock = socket.create_connection(self.tracker_addr, timeout=5)
+            tune_socket(sock)
+            self._tracker_sock = sock
+        return self._tracker_sock
+
+    def _close_tracker_conn(self):
+        """Fecha a conexão persistente com o tracker (chamar com o lock)."""
+        if self._tracker_sock is not None:
+            try:
+                self._tracker_sock.close()
+            except OSError:
+                pass
+            self._tracker_sock = None
+
     def _send_to_tracker(self, message: Dict) -> Optional[Dict]:
-        """Função helper para enviar uma mensagem ao tracker e obter resposta."""
-        try:
-            with socket.create_connection(self.tracker_addr, timeout=5) as s:
-                message['peer_id'] = self.peer_id
-                msg_bytes = json.dumps(message).encode('utf-8')
-                s.sendall(len(msg_bytes).to_bytes(4, 'big') + msg_bytes)
-
-                raw_msglen = s.recv(4)
-                if not raw_msglen: return None
-                msglen = int.from_bytes(raw_msglen, 'big')
-                response_bytes = s.recv(msglen)
-                
-                return json.loads(response_bytes.decode('utf-8'))
-        except (socket.timeout, ConnectionRefusedError, OSError) as e:
-            self.logger.error(f"Não foi possível conectar ao tracker em {self.tracker_addr}: {e}")
-            return None
+        """Envia uma mensagem ao tracker pela conexão persistente."""
+        message['peer_id'] = self.peer_id
+        with self._tracker_lock:
+            # Uma retentativa: a conexão pode ter caído desde o último uso
+            for attempt in (0, 1):
+                try:
+                    s = self._ensure_tracker_conn()
+                    send_message(s, message)
+                    return recv_message(s, self._tracker_rxbuf)
+                except (socket.timeout, ConnectionRefusedError, OSError, ValueError) as e:
+                    self._close_tracker_conn()
+                    if attempt:
+                        self.logger.error("Não foi possível conectar ao tracker em %s: %s", self.tracker_addr, e)
+        return None
 
     def _register_with_tracker(self):
         """Registra este peer no tracker."""
         if not self.block_manager: return
         
+        bitmap, total = self.block_manager.get_have_bitmap()
         message = {
             "command": "REGISTER",
             "file_name": self.block_manager.file_name,
             "address": ('127.0.0.1', self.listen_port),
-            "blocks": list(self.block_manager.get_my_blocks())
+            "bitmap": bitmap,
+            "total": total
         }
-        self.logger.info(f"Registrando no tracker para o arquivo '{self.block_manager.file_name}'...")
+        self.logger.info("Registrando no tracker para o arquivo '%s'...", self.block_manager.file_name)
         self._send_to_tracker(message)
 
-    def _update_tracker_blocks(self):
-        """Atualiza o tracker com la lista de blocos atual."""
+    def _sync_with_tracker(self):
+        """Atualiza nossos blocos no tracker e traz a lista de peers em uma ida."""
         if not self.block_manager: return
 
+        bitmap, total = self.block_manager.get_have_bitmap()
         message = {
-            "command": "UPDATE_BLOCKS",
+            "command": "SYNC",
             "file_name": self.block_manager.file_name,
-            "blocks": list(self.block_manager.get_my_blocks())
+            "bitmap": bitmap,
+            "total": total
         }
-        self._send_to_tracker(message)
-
-    def _update_peers_from_tracker(self):
-        """Obtém e atualiza a lista de peers do tracker."""
-        if not self.download_task: return
-        
-        message = {
-            "command": "GET_PEERS",
-            "file_name": self.download_task['file_name']
-        }
-        self.logger.info("Solicitando lista de peers do tracker...")
         response = self._send_to_tracker(message)
+        if self.download_task:
+            self._merge_peer_list(response)
 
+    def _merge_peer_list(self, response: Optional[Dict]):
+        """Incorpora uma lista de peers retornada pelo tracker."""
         if response and response.get('status') == 'ok':
+            now = time.monotonic()
+            # Prepara as entradas fora do lock: a seção crítica vira só a
+            # fusão no dicionário, sem parse nem montagem de dicts dentro dela
+            entries = [(info['peer_id'], tuple(info['address']),
+                        info['bitmap'], info.get('total', 0))
+                       for info in response.get('peers', [])
+                       if info['peer_id'] != self.peer_id]
+
+            evicted = []
+            new_peers = []
             with self.known_peers_lock:
-                for peer_info in response.get('peers', []):
-                    peer_id = peer_info['peer_id']
-                    if peer_id != self.peer_id and peer_id not in self.known_peers_info:
-                        self.known_peers_info[peer_id] = {
-                            "address": tuple(peer_info['address']),
-                            "blocks": set(peer_info['blocks'])
-                        }
-                        # Alimenta o block_manager com a informação inicial de blocos dos outros
-                        self.block_manager.update_peer_blocks(peer_id, set(peer_info['blocks']))
-            self.logger.info(f"Tracker retornou {len(response.get('peers', []))} peers.")
\ No newline at end of file
+                for peer_id, address, _, _ in entries:
+                    if peer_id not in self.known_peers_info:
+                        new_peers.append(peer_id)
+                    self.known_peers_info[peer_id] = {
+                        "address": address,
+                        "last_seen": now,
+                    }
+                    # Citado de novo pelo tracker: vai para o fim da fila LRU
+                    self.known_peers_info.move_to_end(peer_id)
+                # Cache limitado: descarta os menos citados primeiro
+                while len(self.known_peers_info) > self.MAX_KNOWN_PEERS:
+                    evicted.append(self.known_peers_info.popitem(last=False)[0])
+
+            # Bitmaps dos recém-conhecidos alimentados fora do lock
+            new_set = set(new_peers)
+            for peer_id, _, bitmap, total in entries:
+                if peer_id in new_set:
+                    self.block_manager.update_peer_bitmap(peer_id, bitmap, total)
+            for peer_id in evicted:
+                self.block_manager.remove_peer_blocks(peer_id)
+            if new_peers:
+                # Conecta aos recém-descobertos sem esperar o próximo tick
+                self._mgmt_event.set()
+            self.logger.info("Tracker retornou %s peers.", len(entries))
+
+    def _prune_known_peers(self):
+        """Esquece peers não citados pelo tracker há mais de KNOWN_PEER_TTL."""
+        cutoff = time.monotonic() - self.KNOWN_PEER_TTL
+        with self.connections_lock:
+            connected = set(self.connections.keys())
+        with self.known_peers_lock:
+            stale = [pid for pid, info in self.known_peers_info.items()
+                     if info.get('last_seen', 0) < cutoff and pid not in connected]
+            for pid in stale:
+                del self.known_peers_info[pid]
+        for pid in stale:
+            self.block_manager.remove_peer_blocks(pid)
+            self.logger.debug("Peer %s esquecido (sem notícias do tracker).", pid)
\ No newline at end of file
@@ -1,18 +1,41 @@
 import socket
-import json
 import logging
-from typing import Optional, Dict, Tuple
+import queue
+import threading
+from typing import List, Optional, Dict, Tuple
+
+from .protocol import (HEADER, MAX_MESSAGE_SIZE, parse_message, recv_message,
+                       send_message, tune_socket)
+
 
 class PeerConnection:
     """
     Gerencia a comunicação de baixo nível com um único peer,
     enviando e recebendo mensagens formatadas.
     """
+    # Acima disso, mensagens de posse (substituíveis) são descartadas em
+    # vez de enfileiradas — o resync periódico cobre o que for perdido
+    HIGH_WATERMARK = 64
+
     def __init__(self, address: Tuple[str, int], logger: logging.Logger, sock: Optional[socket.socket] = None):
         self.address = address
         self.logger = logger
         self.socket = sock
         self._connected = sock is not None
+        # Buffer de recepção reutilizado entre mensagens desta conexão
+        self._rxbuf = bytearray(65536)
+        # Estado do parser incremental usado pelo reator: bytes ainda não
+        # consumidos e uma mensagem à espera do payload binário que a segue
+        self._parse_buf = bytearray()
+        self._pending_msg: Optional[Dict] = None
+        self._pending_payload_len = 0
+        # Fila de envio consumida por uma thread escritora dedicada: quem
+        # chama send_message nunca bloqueia num sendall de peer lento
+        self._sendq: queue.SimpleQueue = queue.SimpleQueue()
+        self._writer: Optional[threading.Thread] = None
+        if sock is not None:
+            tune_socket(sock)
+            self._start_writer()
         self._choked_by_peer = True # Começamos 'choked' por padrão
 
     def connect(self) -> bool:
@@ -21,56 +44,149 @@ class PeerConnection:
             return True
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            tune_socket(self.socket)
             self.socket.settimeout(5)
             self.socket.connect(self.address)
             self._connected = True
+            self._start_writer()
             return True
         except (socket.timeout, ConnectionRefusedError, OSError) as e:
-            self.logger.error(f"Falha ao conectar a {self.address}: {e}")
+            self.logger.error("Falha ao conectar a %s: %s", self.address, e)
             self.close()
             return False
 
-    def send_message(self, message: Dict):
-        """Serializa e envia uma mensagem para o peer."""
+    def _start_writer(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+            self._writer.start()
+
+    def _writer_loop(self):
+        """Consome a fila de envio; única thread que escreve no socket."""
+        while True:
+            item = self._sendq.get()
+            if item is None or not self._connected:
+                break
+            try:
+                if isinstance(item, (bytes, memoryview)):
+                    # Frame pré-codificado (broadcast compartilhado)
+                    self.socket.sendall(item)
+                elif isinstance(item[0], (bytes, memoryview)):
+                    # Frame pré-codificado seguido do payload cru
+                    # (block_data servido a partir do cache de frames)
+                    frame, payload = item
+                    sent = self.socket.sendmsg([frame, payload])
+                    if sent < len(frame) + len(payload):
+                        rest = bytes(frame) + bytes(payload)
+                        self.socket.sendall(rest[sent:])
+                else:
+                    message, payload = item
+                    send_message(self.socket, message, payload)
+            except (OSError, BrokenPipeError) as e:
+                self.logger.warning("Erro ao enviar mensagem para %s: %s. Fechando conexão.", self.address, e)
+                self.close()
+                break
+
+    def send_message(self, message: Dict, payload: Optional[bytes] = None):
+        """Enfileira uma mensagem para envio assíncrono ao peer.
+
+        O payload binário opcional (bloco de arquivo) segue cru após o
+        cabeçalho, sem passar pelo codec.
+        """
         if not self.is_connected():
             return
-        try:
-            msg_json = json.dumps(message)
-            msg_bytes = msg_json.encode('utf-8')
-            # Precede a mensagem com seu tamanho (4 bytes, big-endian)
-            self.socket.sendall(len(msg_bytes).to_bytes(4, 'big') + msg_bytes)
-        except (OSError, BrokenPipeError) as e:
-            self.logger.warning(f"Erro ao enviar mensagem para {self.address}: {e}. Fechando conexão.")
-            self.close()
+        if (self._sendq.qsize() > self.HIGH_WATERMARK
+                and message.get('type') in ('have', 'have_delta')):
+            return
+        self._sendq.put_nowait((message, payload))
+
+    def send_raw(self, frame: bytes, droppable: bool = False,
+                 payload: Optional[bytes] = None):
+        """Enfileira um frame já codificado (codifique uma vez, envie a N).
+
+        Broadcasts passam o mesmo objeto bytes imutável para todas as
+        conexões, sem re-serializar a mensagem por peer; block_data em
+        cache passa o frame mais o payload cru que o segue. Com
+        droppable, aplica a mesma política de descarte do marcador
+        d'água usada para mensagens de posse substituíveis.
+        """
+        if not self.is_connected():
+            return
+        if droppable and self._sendq.qsize() > self.HIGH_WATERMARK:
+            return
+        self._sendq.put_nowait(frame if payload is None else (frame, payload))
+
+    def feed(self, data: bytes) -> List[Dict]:
+        """Acumula bytes recebidos e retorna as mensagens completas.
+
+        Parser incremental para o reator: frames parciais ficam no buffer
+        interno até os bytes restantes chegarem. Uma mensagem com
+        payload_len só é emitida quando o payload cru que segue o frame
+        estiver completo (anexado em msg['data']). Levanta ValueError
+        para tamanhos acima de MAX_MESSAGE_SIZE.
+        """
+        buf = self._parse_buf
+        buf += data
+        messages: List[Dict] = []
+        pos = 0
+        while True:
+            # Payload binário pendente da mensagem anterior
+            if self._pending_msg is not None:
+                need = self._pending_payload_len
+                if len(buf) - pos < need:
+                    break
+                msg = self._pending_msg
+                msg['data'] = bytes(buf[pos:pos + need])
+                pos += need
+                self._pending_msg = None
+                messages.append(msg)
+                continue
+
+            if len(buf) - pos < HEADER.size:
+                break
+            (msglen,) = HEADER.unpack_from(buf, pos)
+            if msglen > MAX_MESSAGE_SIZE:
+                raise ValueError(f"Mensagem excede o tamanho máximo: {msglen} bytes")
+            if len(buf) - pos < HEADER.size + msglen:
+                break
+            start = pos + HEADER.size
+            msg = parse_message(memoryview(buf)[start:start + msglen])
+            pos = start + msglen
+
+            payload_len = msg.pop('payload_len', None)
+            if payload_len is not None:
+                if payload_len > MAX_MESSAGE_SIZE:
+                    raise ValueError(f"Payload excede o tamanho máximo: {payload_len} bytes")
+                self._pending_msg = msg
+                self._pending_payload_len = payload_len
+                continue
+            messages.append(msg)
+
+        del buf[:pos]
+        return messages
 
     def read_message(self) -> Optional[Dict]:
-        """Lê e desserializa uma mensagem do peer."""
+        """Lê e desserializa uma mensagem do peer (bloqueante).
+
+        Usado apenas na fase de handshake; depois disso a conexão passa a
+        ser alimentada pelo reator via feed().
+        """
         if not self.is_connected():
             return None
         try:
-            # Lê o tamanho da mensagem
-            raw_msglen = self.socket.recv(4)
-            if not raw_msglen:
-                self.close()
-                return None
-            msglen = int.from_bytes(raw_msglen, 'big')
-            
-            # Lê a mensagem completa
-            data = self.socket.recv(msglen)
-            if not data:
+            message = recv_message(self.socket, self._rxbuf)
+            if message is None:
                 self.close()
-                return None
-            
-            return json.loads(data.decode('utf-8'))
-        except (OSError, json.JSONDecodeError, ConnectionResetError) as e:
-            self.logger.warning(f"Erro ao ler mensagem de {self.address}: {e}. Fechando conexão.")
+            return message
+        except (OSError, ValueError, ConnectionResetError) as e:
+            self.logger.warning("Erro ao ler mensagem de %s: %s. Fechando conexão.", self.address, e)
             self.close()
             return None
 
     def close(self):
-        """Fecha a conexão do socket."""
+        """Fecha a conexão do socket e acorda a thread escritora."""
         if self._connected:
             self._connected = False
+            self._sendq.put_nowait(None)
             if self.socket:
                 self.socket.close()
                 self.socket = None
@@ -82,4 +198,4 @@ class PeerConnection:
         self._choked_by_peer = status
 
     def is_choked_by_peer(self) -> bool:
-        return self._choked_by_peer
\ No newline at end of file
+        return self._choked_by_peer
@@ -0,0 +1,172 @@
+import json
+import socket
+import struct
+from typing import Dict, Optional
+
+# orjson é opcional: serializa direto para bytes (sem o .encode('utf-8')
+# intermediário) e é ~5x mais rápido que o json da stdlib no caminho quente
+# de mensagens. Sem ele instalado, caímos no json padrão de forma transparente.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# msgpack também é opcional e, quando presente, tem prioridade: codifica
+# bytes nativamente, evitando o hex (2x o tamanho) nos payloads de
+# block_data — o tráfego dominante entre peers.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Cabeçalho do frame: tamanho do corpo em 4 bytes big-endian, pré-compilado
+# uma única vez em vez de re-parsear o format string a cada mensagem
+HEADER = struct.Struct('>I')
+
+# Tamanho máximo aceito para o corpo de uma mensagem: um cabeçalho
+# corrompido (ou um peer malicioso) não pode nos fazer alocar gigabytes
+MAX_MESSAGE_SIZE = 8 * 1024 * 1024
+
+
+def _encode(message: Dict) -> bytes:
+    """Serializa o corpo de uma mensagem com o melhor codec disponível."""
+    if msgpack is not None:
+        return msgpack.packb(message, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(message)
+    return json.dumps(message).encode('utf-8')
+
+
+def create_message(message: Dict) -> bytes:
+    """Serializa uma mensagem e a precede com seu tamanho (4 bytes, big-endian)."""
+    body = _encode(message)
+    return HEADER.pack(len(body)) + body
+
+
+def send_message(sock: socket.socket, message: Dict, payload: Optional[bytes] = None):
+    """Serializa e envia uma mensagem em um único write scatter-gather.
+
+    Um payload binário (bloco de arquivo) não entra no corpo serializado:
+    segue cru logo após o frame, anunciado por 'payload_len' no cabeçalho.
+    Isso elimina o hex/base64 no caminho de block_data. sendmsg entrega
+    os buffers sem concatená-los; num envio parcial (raro em sockets
+    bloqueantes), o restante vai via sendall.
+    """
+    if payload is not None:
+        message = dict(message, payload_len=len(payload))
+    body = _encode(message)
+    header = HEADER.pack(len(body))
+    bufs = [header, body] if payload is None else [header, body, payload]
+    sent = sock.sendmsg(bufs)
+    total = sum(len(b) for b in bufs)
+    if sent < total:
+        sock.sendall(b''.join(bufs)[sent:])
+
+
+def parse_message(data: 'bytes | memoryview') -> Dict:
+    """Desserializa o corpo (sem o prefixo de tamanho) de uma mensagem recebida."""
+    if msgpack is not None:
+        return msgpack.unpackb(data, raw=False)
+    if orjson is not None:
+        return orjson.loads(data)
+    if not isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+    return json.loads(data.decode('utf-8'))
+
+
+def read_exact(sock: socket.socket, n: int) -> Optional[bytes]:
+    """Lê exatamente n bytes do socket, acumulando leituras parciais.
+
+    Um único recv() pode retornar menos bytes que o pedido sob segmentação
+    TCP; este loop acumula em um buffer pré-alocado via recv_into, sem
+    realocações. Retorna None apenas em EOF real (conexão fechada).
+    """
+    buf = bytearray(n)
+    view = memoryview(buf)
+    pos = 0
+    while pos < n:
+        read = sock.recv_into(view[pos:])
+        if read == 0:
+            return None
+        pos += read
+    return bytes(buf)
+
+
+def _read_exact_into(sock: socket.socket, n: int, buf: bytearray) -> Optional[memoryview]:
+    """Como read_exact, mas preenchendo um buffer reutilizável do chamador."""
+    if len(buf) < n:
+        buf.extend(bytes(n - len(buf)))
+    view = memoryview(buf)[:n]
+    pos = 0
+    while pos < n:
+        read = sock.recv_into(view[pos:])
+        if read == 0:
+            return None
+        pos += read
+    return view
+
+
+def recv_message(sock: socket.socket, rxbuf: Optional[bytearray] = None) -> Optional[Dict]:
+    """Lê um frame completo (cabeçalho + corpo) do socket e o desserializa.
+
+    Com um rxbuf reutilizável, o corpo é lido nele via recv_into em vez
+    de alocar bytes novos por mensagem (o codec copia o que precisa ao
+    desserializar). Retorna None em EOF; levanta ValueError se o tamanho
+    anunciado exceder MAX_MESSAGE_SIZE.
+    """
+    raw_msglen = read_exact(sock, 4)
+    if raw_msglen is None:
+        return None
+    # int.from_bytes decodifica os 4 bytes direto, sem a tupla
+    # intermediária de Struct.unpack
+    msglen = int.from_bytes(raw_msglen, 'big')
+    if msglen > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Mensagem excede o tamanho máximo: {msglen} bytes")
+    if rxbuf is not None:
+        body = _read_exact_into(sock, msglen, rxbuf)
+    else:
+        body = read_exact(sock, msglen)
+    if body is None:
+        return None
+    message = parse_message(body)
+
+    # Payload binário fora do corpo serializado (blocos de arquivo)
+    payload_len = message.pop('payload_len', None)
+    if payload_len is not None:
+        if payload_len > MAX_MESSAGE_SIZE:
+            raise ValueError(f"Payload excede o tamanho máximo: {payload_len} bytes")
+        payload = read_exact(sock, payload_len)
+        if payload is None:
+            return None
+        message['data'] = payload
+    return message
+
+
+# Buffers de socket maiores dão folga para as rajadas de block_data
+_SOCKET_BUF_SIZE = 1 << 20  # 1 MiB
+
+
+def tune_socket(sock: socket.socket):
+    """Aplica TCP_NODELAY, keepalive e buffers maiores de envio/recepção.
+
+    Sem TCP_NODELAY, as mensagens pequenas de controle (have, choke,
+    request_block) podem esperar até 40ms no algoritmo de Nagle. O
+    keepalive detecta peers que sumiram sem fechar a conexão, em vez de
+    manter o estado deles para sempre.
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _SOCKET_BUF_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _SOCKET_BUF_SIZE)
+    except OSError:
+        # Plataforma sem suporte a alguma das opções; seguimos sem ajuste
+        pass
+    # Parâmetros de keepalive agressivos (Linux): sonda após 30s ocioso,
+    # a cada 10s, e desiste na 3ª falha (~1 minuto para detectar)
+    for opt, value in (('TCP_KEEPIDLE', 30), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3)):
+        if hasattr(socket, opt):
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+            except OSError:
+                pass
@@ -1,10 +1,13 @@
 import socket
+import selectors
 import threading
-import json
 import logging
 import random
 from typing import Dict, List, Tuple, Set
 
+from .protocol import (HEADER, MAX_MESSAGE_SIZE, parse_message, send_message,
+                       tune_socket)
+
 class Tracker:
     """
     Tracker central para o sistema MiniBit.
@@ -14,11 +17,30 @@ class Tracker:
     def __init__(self, host='127.0.0.1', port=8000):
         self.host = host
         self.port = port
-        # Estrutura: {file_name: {peer_id: (ip, port, {block_ids})}}
-        self.files: Dict[str, Dict[str, Tuple[str, int, Set[str]]]] = {}
+        # Estrutura: {file_name: {peer_id: (ip, port, bitmap_b64, total)}}
+        # O bitmap de blocos é opaco para o tracker: ele só o repassa
+        self.files: Dict[str, Dict[str, Tuple[str, int, str, int]]] = {}
+        # self.lock protege apenas a estrutura de self.files/_file_locks;
+        # cada arquivo tem seu próprio lock, para que peers de arquivos
+        # diferentes não serializem no mesmo mutex
         self.lock = threading.Lock()
+        self._file_locks: Dict[str, threading.Lock] = {}
+        # Índice reverso peer -> arquivos em que ele está registrado:
+        # remover um peer não exige varrer todos os arquivos do tracker
+        self._peer_files: Dict[str, Set[str]] = {}
+        # Lista paralela de peer_ids por arquivo (com mapa id -> índice
+        # para remoção por swap-pop): a amostragem de GET_PEERS sorteia
+        # direto da lista, sem varrer todos os peers do arquivo. Updates
+        # de bitmap não mexem na lista, só entrada e saída de peers
+        self._file_peer_ids: Dict[str, List[str]] = {}
+        self._file_pid_index: Dict[str, Dict[str, int]] = {}
         self.server_socket = None
         self.running = False
+        # Reator: um único seletor multiplexa o socket de escuta e todas
+        # as conexões de peers, em vez de uma thread por cliente
+        self._selector = selectors.DefaultSelector()
+        # Buffer de recepção compartilhado do reator (uma thread só)
+        self._rxbuf = bytearray(65536)
         self.logger = logging.getLogger("Tracker")
 
     def start(self):
@@ -28,140 +50,209 @@ class Tracker:
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(5)
         self.running = True
-        self.logger.info(f"Servidor iniciado em {self.host}:{self.port}")
+        self.logger.info("Servidor iniciado em %s:%s", self.host, self.port)
 
-        thread = threading.Thread(target=self._accept_connections, daemon=True)
+        thread = threading.Thread(target=self._reactor, daemon=True)
         thread.start()
-        # Permite que o programa principal continue para aguardar um KeyboardInterrupt
-        while self.running:
-            try:
-                threading.Event().wait()
-            except KeyboardInterrupt:
-                self.stop()
+        # Estaciona a thread principal sem acordar: um único wait num
+        # Event que nunca é setado, interrompido apenas pelo Ctrl+C
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            self.stop()
 
 
-    def _accept_connections(self):
-        """Loop para aceitar novas conexões de peers."""
+    def _reactor(self):
+        """Laço único de I/O: aceita conexões e atende todos os peers.
+
+        Os sockets permanecem bloqueantes; o seletor só indica prontidão
+        de leitura e as respostas (pequenas) saem na própria iteração —
+        o mesmo desenho do reator do Peer, sem uma thread por cliente.
+        """
+        self._selector.register(self.server_socket, selectors.EVENT_READ, None)
         while self.running:
-            try:
-                conn, addr = self.server_socket.accept()
-                self.logger.info(f"Nova conexão de {addr}")
-                handler_thread = threading.Thread(target=self._handle_client, args=(conn, addr), daemon=True)
-                handler_thread.start()
-            except OSError:
-                # Ocorre quando o socket é fechado em self.stop()
-                break
-            except Exception as e:
-                if self.running:
-                    self.logger.error(f"Erro ao aceitar conexões: {e}")
-
-    def _handle_client(self, conn: socket.socket, addr: Tuple[str, int]):
-        """Processa mensagens de um peer conectado."""
-        peer_id_for_session = None
-        connection_alive = True
+            events = self._selector.select(timeout=0.5)
+            for key, _ in events:
+                if key.data is None:
+                    self._accept_client()
+                else:
+                    self._service_client(key.fileobj, key.data)
+
+    def _accept_client(self):
+        """Aceita uma conexão e a registra no seletor."""
+        try:
+            conn, addr = self.server_socket.accept()
+        except OSError:
+            # Ocorre quando o socket é fechado em self.stop()
+            return
+        tune_socket(conn)
+        self.logger.info("Nova conexão de %s", addr)
+        # Estado por conexão: buffer de parse incremental e o peer_id
+        # visto na sessão (para limpeza em caso de queda)
+        self._selector.register(conn, selectors.EVENT_READ,
+                                {'addr': addr, 'buf': bytearray(), 'peer_id': None})
+
+    def _service_client(self, conn: socket.socket, state: Dict):
+        """Drena o socket e processa as mensagens completas do buffer."""
+        try:
+            nbytes = conn.recv_into(self._rxbuf)
+        except (ConnectionResetError, OSError) as e:
+            self._drop_client(conn, state, error=e)
+            return
+        if not nbytes:
+            self._drop_client(conn, state)
+            return
+
+        buf = state['buf']
+        buf += memoryview(self._rxbuf)[:nbytes]
         try:
-            with conn:
-                while connection_alive:
-                    # Lê o tamanho da mensagem (4 bytes)
-                    raw_msglen = conn.recv(4)
-                    if not raw_msglen:
-                        break # Conexão fechada pelo cliente
-                    msglen = int.from_bytes(raw_msglen, 'big')
-                    
-                    data = conn.recv(msglen)
-                    if not data:
-                        break # Conexão fechada pelo cliente
-                    
-                    message = json.loads(data.decode('utf-8'))
-                    peer_id_for_session = message.get('peer_id')
-                    
-                    response = self._process_command(message)
-                    
-                    response_bytes = json.dumps(response).encode('utf-8')
-                    conn.sendall(len(response_bytes).to_bytes(4, 'big') + response_bytes)
-                    
-
-                    connection_alive = False
-
-        except (ConnectionResetError, BrokenPipeError, json.JSONDecodeError) as e:
-
-            self.logger.warning(f"Conexão com {addr} (Peer: {peer_id_for_session}) perdida ou corrompida: {e}")
-            if peer_id_for_session:
-                self._remove_peer(peer_id_for_session)
+            while len(buf) >= HEADER.size:
+                (msglen,) = HEADER.unpack_from(buf)
+                if msglen > MAX_MESSAGE_SIZE:
+                    raise ValueError(f"Mensagem excede o tamanho máximo: {msglen} bytes")
+                if len(buf) < HEADER.size + msglen:
+                    break
+                message = parse_message(memoryview(buf)[HEADER.size:HEADER.size + msglen])
+                del buf[:HEADER.size + msglen]
+                state['peer_id'] = message.get('peer_id') or state['peer_id']
+                response = self._process_command(message)
+                send_message(conn, response)
         except Exception as e:
-            self.logger.error(f"Erro ao lidar com o cliente {addr} (Peer: {peer_id_for_session}): {e}")
-            if peer_id_for_session:
-                self._remove_peer(peer_id_for_session)
-        finally:
+            # Captura ampla: uma mensagem malformada (ex.: REGISTER sem
+            # um campo obrigatório) derruba só a conexão ofensora, nunca
+            # o reator que atende todos os clientes
+            self._drop_client(conn, state, error=e)
+
+    def _drop_client(self, conn: socket.socket, state: Dict, error=None):
+        """Desregistra e fecha uma conexão; remove o peer se houve erro."""
+        peer_id = state['peer_id']
+        if error is not None:
+            self.logger.warning("Conexão com %s (Peer: %s) perdida ou corrompida: %s", state['addr'], peer_id, error)
+            if peer_id:
+                self._remove_peer(peer_id)
+        try:
+            self._selector.unregister(conn)
+        except (KeyError, ValueError):
+            pass
+        conn.close()
+        self.logger.info("Comunicação com %s (Peer: %s) finalizada.", state['addr'], peer_id)
 
-            self.logger.info(f"Comunicação com {addr} (Peer: {peer_id_for_session}) finalizada.")
 
+    def _get_file_entry(self, file_name: str, create: bool = False):
+        """Retorna (peers, lock) de um arquivo, criando a entrada se pedido."""
+        with self.lock:
+            if file_name not in self.files:
+                if not create:
+                    return None, None
+                self.files[file_name] = {}
+                self._file_locks[file_name] = threading.Lock()
+            return self.files[file_name], self._file_locks[file_name]
 
     def _process_command(self, message: Dict) -> Dict:
         """Processa um comando recebido e retorna uma resposta."""
         command = message.get('command')
         peer_id = message.get('peer_id')
-        
-        with self.lock:
-            if command == 'REGISTER':
-                file_name = message['file_name']
-                peer_addr = message['address']
-                blocks = set(message['blocks'])
-                
-                if file_name not in self.files:
-                    self.files[file_name] = {}
-                
-                self.files[file_name][peer_id] = (peer_addr[0], peer_addr[1], blocks)
-                self.logger.info(f"Peer {peer_id} registrado para o arquivo '{file_name}' com {len(blocks)} blocos.")
+
+        if command == 'REGISTER':
+            file_name = message['file_name']
+            peer_addr = message['address']
+
+            peers, file_lock = self._get_file_entry(file_name, create=True)
+            with file_lock:
+                if peer_id not in peers:
+                    ids = self._file_peer_ids.setdefault(file_name, [])
+                    self._file_pid_index.setdefault(file_name, {})[peer_id] = len(ids)
+                    ids.append(peer_id)
+                peers[peer_id] = (peer_addr[0], peer_addr[1], message['bitmap'], message.get('total', 0))
+            with self.lock:
+                self._peer_files.setdefault(peer_id, set()).add(file_name)
+            self.logger.info("Peer %s registrado para o arquivo '%s'.", peer_id, file_name)
+            return {"status": "ok"}
+
+        elif command == 'GET_PEERS':
+            file_name = message['file_name']
+            peers_list = self._build_peers_list(file_name, peer_id)
+            self.logger.info("Enviando %s peers para %s para o arquivo '%s'.", len(peers_list), peer_id, file_name)
+            return {"status": "ok", "peers": peers_list}
+
+        elif command == 'UPDATE_BLOCKS':
+            file_name = message['file_name']
+            if self._update_peer_entry(file_name, peer_id, message['bitmap'], message.get('total', 0)):
                 return {"status": "ok"}
+            return {"status": "error", "message": "Peer or file not found"}
+
+        elif command == 'SYNC':
+            # Comando composto: atualiza os blocos do peer e devolve a
+            # lista de peers em uma única ida ao tracker
+            file_name = message['file_name']
+            self._update_peer_entry(file_name, peer_id, message['bitmap'], message.get('total', 0))
+            peers_list = self._build_peers_list(file_name, peer_id)
+            return {"status": "ok", "peers": peers_list}
 
-            elif command == 'GET_PEERS':
-                file_name = message['file_name']
-                peers_list = []
-                if file_name in self.files:
-                    all_peers = self.files[file_name]
-                    # Retorna todos os outros peers que têm o arquivo
-                    other_peers = {pid: pinfo for pid, pinfo in all_peers.items() if pid != peer_id}
-                    
-
-                    if len(other_peers) < 5: # 
-                        selected_peers = list(other_peers.items())
-                    else:
-                        selected_peers = random.sample(list(other_peers.items()), 5)
-
-                    for pid, (ip, port, blocks) in selected_peers:
-                        peers_list.append({"peer_id": pid, "address": (ip, port), "blocks": list(blocks)})
-                
-                self.logger.info(f"Enviando {len(peers_list)} peers para {peer_id} para o arquivo '{file_name}'.")
-                return {"status": "ok", "peers": peers_list}
-
-            elif command == 'UPDATE_BLOCKS':
-                file_name = message['file_name']
-                new_blocks = set(message['blocks'])
-                if file_name in self.files and peer_id in self.files[file_name]:
-                    ip, port, _ = self.files[file_name][peer_id]
-                    self.files[file_name][peer_id] = (ip, port, new_blocks)
-                    return {"status": "ok"}
-                return {"status": "error", "message": "Peer or file not found"}
-
-            else:
-                return {"status": "error", "message": "Comando desconhecido"}
+        else:
+            return {"status": "error", "message": "Comando desconhecido"}
+
+    def _update_peer_entry(self, file_name: str, peer_id: str, bitmap: str, total: int) -> bool:
+        """Substitui o bitmap de blocos de um peer já registrado."""
+        peers, file_lock = self._get_file_entry(file_name)
+        if peers is None:
+            return False
+        with file_lock:
+            if peer_id not in peers:
+                return False
+            ip, port, _, _ = peers[peer_id]
+            peers[peer_id] = (ip, port, bitmap, total)
+            return True
+
+    def _build_peers_list(self, file_name: str, peer_id: str) -> List[Dict]:
+        """Monta a lista de outros peers de um arquivo."""
+        peers, file_lock = self._get_file_entry(file_name)
+        if peers is None:
+            return []
+
+        # Amostra direto da lista de ids (sorteando um a mais para poder
+        # excluir o próprio requisitante sem varrer todos os peers);
+        # a serialização acontece fora da seção crítica
+        with file_lock:
+            ids = self._file_peer_ids.get(file_name, [])
+            sampled = random.sample(ids, 6) if len(ids) > 6 else list(ids)
+            other_peers = [(pid, peers[pid]) for pid in sampled if pid != peer_id][:5]
+
+        return [{"peer_id": pid, "address": (ip, port), "bitmap": bitmap, "total": total}
+                for pid, (ip, port, bitmap, total) in other_peers]
 
     def _remove_peer(self, peer_id_to_remove: str):
-        """Remove um peer de todos os registros quando ele se desconecta com erro."""
+        """Remove um peer de todos os registros quando ele se desconecta com erro.
+
+        O índice reverso diz exatamente em quais arquivos o peer está:
+        o custo é proporcional aos arquivos dele, não a todos os
+        arquivos do tracker, e só os locks desses arquivos são tomados.
+        """
         with self.lock:
-            for file_name in self.files:
-                if peer_id_to_remove in self.files[file_name]:
-                    del self.files[file_name][peer_id_to_remove]
-                    self.logger.info(f"Peer {peer_id_to_remove} removido (devido a erro/desconexão) do arquivo '{file_name}'.")
+            file_names = self._peer_files.pop(peer_id_to_remove, set())
+            targets = [(fn, self.files.get(fn), self._file_locks.get(fn)) for fn in file_names]
+        for file_name, peers, file_lock in targets:
+            if peers is None or file_lock is None:
+                continue
+            with file_lock:
+                removed = peers.pop(peer_id_to_remove, None)
+                # Swap-pop na lista paralela: remoção O(1) sem buraco
+                index = self._file_pid_index.get(file_name, {})
+                idx = index.pop(peer_id_to_remove, None)
+                if idx is not None:
+                    ids = self._file_peer_ids[file_name]
+                    last = ids.pop()
+                    if last != peer_id_to_remove:
+                        ids[idx] = last
+                        index[last] = idx
+            if removed is not None:
+                self.logger.info("Peer %s removido (devido a erro/desconexão) do arquivo '%s'.", peer_id_to_remove, file_name)
 
     def stop(self):
         """Para o servidor do tracker."""
         self.running = False
+        # O select com timeout do reator percebe a parada sozinho; basta
+        # fechar o socket de escuta
         if self.server_socket:
-            try:
-                socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((self.host, self.port))
-            except ConnectionRefusedError:
-                pass # Normal se o servidor já estiver parando
             self.server_socket.close()
         self.logger.info("Tracker parado.")
@@ -1,29 +1,56 @@
+import heapq
 import random
 import logging
-from typing import Set, Dict, List, Tuple
+from typing import Dict, FrozenSet, List, Optional, Tuple
 
 class UnchokeManager:
     """
     Implementa a estratégia 'olho por olho' (tit-for-tat) simplificada.
-    - Desbloqueia (unchokes) os 4 peers que oferecem os blocos mais raros.
+    - Desbloqueia (unchokes) os 4 peers que mais nos enviaram blocos.
     - Desbloqueia 1 peer adicional de forma otimista.
     - Bloqueia (chokes) todos os outros.
     """
     MAX_FIXED_UNCHOKED = 4 # Conforme requisito, 4 fixos + 1 otimista 
+    # Peso do bloco mais recente na média móvel exponencial de vazão
+    EMA_ALPHA = 0.1
+    # Histerese: um fixo atual só é demovido se sua média cair abaixo
+    # desta fração da média do pior recém-classificado (evita churn de
+    # choke/unchoke entre peers de desempenho parecido)
+    HYSTERESIS = 0.8
     
     def __init__(self, my_peer_id: str, logger: logging.Logger):
         self.my_peer_id = my_peer_id
         self.logger = logger
-        
-        self.fixed_unchoked: Set[str] = set()
-        self.optimistic_unchoke: str | None = None
+
+        # Estado (fixos, otimista) como uma tupla imutável trocada por
+        # uma única atribuição: is_unchoked roda a cada request_block no
+        # reator e lê um snapshot consistente sem lock, enquanto o timer
+        # de unchoke substitui a tupla inteira de uma vez
+        self._state: Tuple[FrozenSet[str], Optional[str]] = (frozenset(), None)
+        # Média móvel exponencial de bytes úteis recebidos por peer:
+        # quem nos serve mais rápido ganha os slots fixos
+        self.peer_ema: Dict[str, float] = {}
+
+    @property
+    def fixed_unchoked(self) -> FrozenSet[str]:
+        return self._state[0]
+
+    @property
+    def optimistic_unchoke(self) -> Optional[str]:
+        return self._state[1]
+
+    def record_block_received(self, peer_id: str, nbytes: int):
+        """Registra bytes úteis recebidos de um peer na média móvel."""
+        current = self.peer_ema.get(peer_id, 0.0)
+        self.peer_ema[peer_id] = (1 - self.EMA_ALPHA) * current + self.EMA_ALPHA * nbytes
 
     def unregister_peer(self, peer_id: str):
         """Remove um peer da consideração para unchoke."""
-        if peer_id in self.fixed_unchoked:
-            self.fixed_unchoked.remove(peer_id)
-        if self.optimistic_unchoke == peer_id:
-            self.optimistic_unchoke = None
+        self.peer_ema.pop(peer_id, None)
+        fixed, optimistic = self._state
+        if peer_id in fixed or optimistic == peer_id:
+            self._state = (fixed - {peer_id},
+                           None if optimistic == peer_id else optimistic)
             
     def evaluate_peers(self, interested_peers: List[str], block_rarity: Dict[str, int]) -> Tuple[List[str], List[str]]:
         """
@@ -33,38 +60,73 @@ class UnchokeManager:
         if not interested_peers:
             return list(self.fixed_unchoked) + ([self.optimistic_unchoke] if self.optimistic_unchoke else []), []
 
-        # Calcula a 'pontuação' de cada peer interessado
-        peer_scores = {}
+        # Slots fixos por mérito: os 4 com maior média de vazão recente;
+        # empates (tipicamente os ainda sem histórico) se resolvem na sorte
+        ema = self.peer_ema
+        ranked = heapq.nlargest(self.MAX_FIXED_UNCHOKED, interested_peers,
+                                key=lambda p: (ema.get(p, 0.0), random.random()))
+        current_fixed, _ = self._state
+        new_fixed_unchoked = set(ranked)
+
+        # Histerese: um fixo atual ainda interessado só perde o slot se
+        # estiver bem abaixo do pior recém-classificado
+        if len(ranked) == self.MAX_FIXED_UNCHOKED:
+            floor = self.HYSTERESIS * ema.get(ranked[-1], 0.0)
+            survivors = [p for p in current_fixed
+                         if p not in new_fixed_unchoked and p in interested_peers
+                         and ema.get(p, 0.0) >= floor]
+            for survivor in survivors:
+                # Devolve o slot trocando pelo pior colocado que não era fixo
+                for i in range(len(ranked) - 1, -1, -1):
+                    if ranked[i] in new_fixed_unchoked and ranked[i] not in current_fixed:
+                        new_fixed_unchoked.discard(ranked[i])
+                        new_fixed_unchoked.add(survivor)
+                        ranked[i] = survivor
+                        break
+
+        # A média decai a cada tick: desempenho antigo pesa cada vez menos
+        # e peers que pararam de enviar perdem o slot naturalmente
+        for peer_id in list(ema):
+            ema[peer_id] *= 0.5
+
+        # Seleciona o peer otimista por amostragem de reservatório: uma
+        # passada, sem materializar a lista dos não-fixos
+        new_optimistic_unchoke = None
+        seen = 0
         for peer_id in interested_peers:
-            score = 0
-            for block, rarity in block_rarity.items():
-                 pass # A lógica real será mais simples abaixo.
-            
-        
-        # Sorteia os interessados para decidir quem será 'fixo'
-        random.shuffle(interested_peers)
-        new_fixed_unchoked = set(interested_peers[:self.MAX_FIXED_UNCHOKED])
+            if peer_id in new_fixed_unchoked:
+                continue
+            seen += 1
+            if random.random() * seen < 1.0:
+                new_optimistic_unchoke = peer_id
 
-        # Seleciona o peer otimista
-        potential_optimistic = [p for p in interested_peers if p not in new_fixed_unchoked]
-        new_optimistic_unchoke = random.choice(potential_optimistic) if potential_optimistic else None
+        # Determina quem mudou de estado comparando direto com o estado
+        # anterior: com no máximo 5 desbloqueados, testes de pertinência
+        # saem mais baratos que montar unions e diferenças temporárias
+        to_unchoke = [p for p in new_fixed_unchoked
+                      if p not in self.fixed_unchoked and p != self.optimistic_unchoke]
+        if (new_optimistic_unchoke is not None
+                and new_optimistic_unchoke not in self.fixed_unchoked
+                and new_optimistic_unchoke != self.optimistic_unchoke):
+            to_unchoke.append(new_optimistic_unchoke)
 
-        # Determina quem mudou de estado
-        currently_unchoked = self.fixed_unchoked.union({self.optimistic_unchoke} if self.optimistic_unchoke else set())
-        newly_unchoked_total = new_fixed_unchoked.union({new_optimistic_unchoke} if new_optimistic_unchoke else set())
-        
-        to_unchoke = list(newly_unchoked_total - currently_unchoked)
-        to_choke = list(currently_unchoked - newly_unchoked_total)
-        
-        # Atualiza o estado interno
-        self.fixed_unchoked = new_fixed_unchoked
-        self.optimistic_unchoke = new_optimistic_unchoke
+        to_choke = [p for p in self.fixed_unchoked
+                    if p not in new_fixed_unchoked and p != new_optimistic_unchoke]
+        if (self.optimistic_unchoke is not None
+                and self.optimistic_unchoke not in new_fixed_unchoked
+                and self.optimistic_unchoke != new_optimistic_unchoke):
+            to_choke.append(self.optimistic_unchoke)
+
+        # Troca atômica do estado: leitores veem o par antigo ou o novo,
+        # nunca um misto
+        self._state = (frozenset(new_fixed_unchoked), new_optimistic_unchoke)
 
         if to_unchoke or to_choke:
-            self.logger.info(f"Decisão de Unchoke: Fixos={list(self.fixed_unchoked)}, Otimista={self.optimistic_unchoke}")
+            self.logger.info("Decisão de Unchoke: Fixos=%s, Otimista=%s", list(self.fixed_unchoked), self.optimistic_unchoke)
 
         return to_choke, to_unchoke
         
     def is_unchoked(self, peer_id: str) -> bool:
         """Verifica se um peer específico está na lista de unchoked."""
-        return peer_id in self.fixed_unchoked or peer_id == self.optimistic_unchoke
+        fixed, optimistic = self._state
+        return peer_id in fixed or peer_id == optimistic